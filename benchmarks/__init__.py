@@ -0,0 +1,33 @@
+"""Offline benchmarks of the pyrus hot paths.
+
+Run them all, or some, from the repository root and get JSON results:
+
+	PYTHONPATH=src python -m benchmarks [--quick] [--output FILE] [CASE...]
+"""
+import platform
+import sys
+from time import perf_counter
+
+REPEAT = 3
+
+def timed(func, repeat=REPEAT):
+	"""Returns the best wall time of repeat calls to func, in seconds"""
+	best = None
+	for _ in range(repeat):
+		start = perf_counter()
+		func()
+		elapsed = perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def result(name, params, **metrics):
+	return {'name': name, 'params': params, 'metrics': metrics}
+
+def environment():
+	return {
+		'python': platform.python_version(),
+		'implementation': platform.python_implementation(),
+		'platform': platform.platform(),
+		'executable': sys.executable,
+		}
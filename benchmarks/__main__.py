@@ -0,0 +1,33 @@
+import json
+from argparse import ArgumentParser
+from importlib import import_module
+from benchmarks import environment
+
+CASES = ['checksum', 'archives', 'logging', 'download']
+
+def main(argv=None):
+	parser = ArgumentParser(prog='python -m benchmarks',
+						description='Runs the pyrus benchmarks, printing JSON')
+	parser.add_argument('cases', nargs='*', metavar='CASE',
+						help='one of %s (default: all)' % ', '.join(CASES))
+	parser.add_argument('--quick', action='store_true',
+						help='smaller inputs, for a smoke run')
+	parser.add_argument('--output', '-o', help='write the JSON to this file')
+	args = parser.parse_args(argv)
+	unknown = [ case for case in args.cases if case not in CASES ]
+	if unknown:
+		parser.error('unknown cases: %s' % ', '.join(unknown))
+	results = []
+	for case in args.cases or CASES:
+		module = import_module('benchmarks.bench_%s' % case)
+		results.extend(module.run(args.quick))
+	report = json.dumps({'environment': environment(), 'quick': args.quick,
+						'results': results}, indent=2)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(report + '\n')
+	else:
+		print(report)
+
+if __name__ == '__main__':
+	main()
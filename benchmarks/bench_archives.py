@@ -0,0 +1,64 @@
+import os
+import tarfile
+import zipfile
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from pyrus.archives import ZipFile, TarFile
+from benchmarks import timed, result
+
+# Member count and member size of the generated archives
+SHAPES = [(2000, 1 << 10), (50, 1 << 20)]
+QUICK_SHAPES = [(200, 1 << 10), (5, 1 << 20)]
+
+def _payload(size):
+	# Half random so compression has some work but does not dominate
+	return os.urandom(size // 2) + bytes(size - size // 2)
+
+def _write_zip(path, count, size):
+	with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+		for i in range(count):
+			zf.writestr('dir%d/member%d' % (i % 10, i), _payload(size))
+
+def _write_tar(path, count, size, mode):
+	with tarfile.open(path, mode) as tf:
+		for i in range(count):
+			data = _payload(size)
+			info = tarfile.TarInfo('dir%d/member%d' % (i % 10, i))
+			info.size = len(data)
+			tf.addfile(info, BytesIO(data))
+
+def _extract_all(archive):
+	for stream in archive.extract_all().values():
+		stream.read()
+
+def _iter_members(archive):
+	for _, stream in archive.iter_members():
+		if stream:
+			stream.read()
+
+def run(quick=False):
+	results = []
+	with TemporaryDirectory() as tmp:
+		for count, size in QUICK_SHAPES if quick else SHAPES:
+			paths = {
+				'zip': os.path.join(tmp, 'bench.zip'),
+				'tar': os.path.join(tmp, 'bench.tar'),
+				'tar.gz': os.path.join(tmp, 'bench.tar.gz'),
+				}
+			_write_zip(paths['zip'], count, size)
+			_write_tar(paths['tar'], count, size, 'w')
+			_write_tar(paths['tar.gz'], count, size, 'w:gz')
+			for kind, path in sorted(paths.items()):
+				cls = ZipFile if kind == 'zip' else TarFile
+				params = {'format': kind, 'members': count, 'member_bytes': size}
+				seconds = timed(lambda: cls(path).filelist)
+				results.append(result('archives.list', params,
+					seconds=seconds, members_per_s=count / seconds))
+				archive = cls(path)
+				for name, func in [('archives.extract_all', _extract_all),
+						('archives.iter_members', _iter_members)]:
+					seconds = timed(lambda: func(archive))
+					results.append(result(name, params, seconds=seconds,
+						members_per_s=count / seconds,
+						mb_per_s=count * size / seconds / 1e6))
+	return results
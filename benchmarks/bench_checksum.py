@@ -0,0 +1,21 @@
+import os
+from tempfile import TemporaryDirectory
+from pyrus.checksum import algorithms, hexdigest
+from benchmarks import timed, result
+
+SIZES = [1 << 20, 16 << 20]
+QUICK_SIZES = [1 << 20]
+
+def run(quick=False):
+	results = []
+	with TemporaryDirectory() as tmp:
+		for size in QUICK_SIZES if quick else SIZES:
+			path = os.path.join(tmp, 'data-%d' % size)
+			with open(path, 'wb') as f:
+				f.write(os.urandom(size))
+			for algorithm in sorted(algorithms):
+				seconds = timed(lambda: hexdigest(path, algorithm))
+				results.append(result('checksum.hexdigest',
+					{'algorithm': algorithm, 'bytes': size},
+					seconds=seconds, mb_per_s=size / seconds / 1e6))
+	return results
@@ -0,0 +1,57 @@
+import os
+import threading
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from pyrus.web import download
+from benchmarks import result
+
+DOWNLOADS = 200
+QUICK_DOWNLOADS = 20
+FILE_SIZES = [1 << 10, 1 << 20]
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+	def log_message(self, *args):
+		pass
+
+def _serve(root):
+	handler = partial(_QuietHandler, directory=root)
+	server = HTTPServer(('127.0.0.1', 0), handler)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	return server
+
+def run(quick=False):
+	results = []
+	count = QUICK_DOWNLOADS if quick else DOWNLOADS
+	with TemporaryDirectory() as root:
+		server = _serve(root)
+		base = 'http://127.0.0.1:%d/' % server.server_port
+		for size in FILE_SIZES:
+			name = 'file-%d' % size
+			data = os.urandom(size)
+			with open(os.path.join(root, name), 'wb') as f:
+				f.write(data)
+			# Query strings keep the urls, and so the downloads, distinct
+			urls = [ '%s%s?%d' % (base, name, i) for i in range(count) ]
+			start = perf_counter()
+			pending = [ download.download_async(url) for url in urls ]
+			# Seconds from the first request till each download completed, as
+			# seen by a caller fetching them in order
+			latencies = []
+			for r in pending:
+				payload = download.fetch_result(r)
+				latencies.append(perf_counter() - start)
+				if payload is None or payload.getvalue() != data:
+					raise AssertionError('%s: download failed' % r.url)
+			seconds = perf_counter() - start
+			latencies.sort()
+			results.append(result('download.pool', {'downloads': count,
+				'bytes': size}, seconds=seconds,
+				downloads_per_s=count / seconds,
+				mb_per_s=count * size / seconds / 1e6,
+				completed_p50=latencies[len(latencies) // 2],
+				completed_max=latencies[-1]))
+		server.shutdown()
+	return results
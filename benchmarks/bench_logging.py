@@ -0,0 +1,54 @@
+import os
+from multiprocessing import Process
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+from pyrus import mplogging
+from pyrus.mplogging import Logger, read_log, INFO
+from benchmarks import result
+
+PRODUCERS = [1, 2, 4, 8]
+QUICK_PRODUCERS = [1, 2]
+LINES = 500
+QUICK_LINES = 100
+# Give up waiting for lines to reach the sink after this many seconds
+DRAIN_TIMEOUT = 120
+
+def _produce(logger, lines):
+	for i in range(lines):
+		logger.info('benchmark line %d' % i)
+
+def _count(path):
+	return sum(1 for _ in read_log(path))
+
+def run(quick=False):
+	results = []
+	lines = QUICK_LINES if quick else LINES
+	with TemporaryDirectory() as tmp:
+		sink = os.path.join(tmp, 'bench.log')
+		# Records go to a binary sink so the terminal is not the bottleneck
+		mplogging.start(sink=sink)
+		logger = Logger('benchmarks.logging', INFO)
+		# Resolve the logger once, producers inherit the proxy
+		logger.get_log_level()
+		expected = 0
+		for producers in QUICK_PRODUCERS if quick else PRODUCERS:
+			expected += producers * lines
+			start = perf_counter()
+			workers = [ Process(target=_produce, args=(logger, lines))
+						for _ in range(producers) ]
+			for worker in workers:
+				worker.start()
+			for worker in workers:
+				worker.join()
+			produced = perf_counter() - start
+			while _count(sink) < expected:
+				if perf_counter() - start > DRAIN_TIMEOUT:
+					break
+				sleep(0.01)
+			seconds = perf_counter() - start
+			results.append(result('logging.lines', {'producers': producers,
+				'lines_per_producer': lines}, seconds=seconds,
+				produce_seconds=produced,
+				lines_per_s=producers * lines / seconds,
+				delivered=_count(sink) - expected + producers * lines))
+	return results
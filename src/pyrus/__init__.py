@@ -1,13 +1,138 @@
+import asyncio
+import json
 from abc import abstractmethod, ABCMeta
-from multiprocessing import Manager, Process
+import multiprocessing
+import threading
+from ctypes import Structure, c_uint32, c_uint64, c_int32, c_int64
+from hashlib import blake2b
+from multiprocessing import Manager, Process, Lock
+from multiprocessing.sharedctypes import RawArray
 from multiprocessing.util import ForkAwareThreadLock
 from multiprocessing.queues import Empty
 from os import urandom
-from time import sleep
+from queue import SimpleQueue, Queue, Full
+from threading import Thread
+from time import sleep, monotonic
+from traceback import print_exc
 
 def enum(**enums):
 	return type('Enum', (), enums)
 
+# The manager used by all borgs of this process, started on first use
+_manager = None
+_manager_lock = ForkAwareThreadLock()
+
+def shared_manager():
+	"""Returns the multiprocessing manager shared by the borgs created in this
+	process, starting it if required."""
+	global _manager
+	with _manager_lock:
+		if _manager is None:
+			_manager = Manager()
+	return _manager
+
+STATE_TABLE_SIZE = 4096
+# Reserved slot keys, hashes colliding with them are shifted
+_EMPTY_KEY = 0
+_DELETED_KEY = 1
+
+class StateTableFullException(Exception): pass
+
+class _StateSlot(Structure):
+	_fields_ = [('seq', c_uint32), ('key', c_uint64), ('state', c_int32)]
+
+def state_key(key):
+	"""Hashes a str or bytes key to the 64 bit key used in a SharedStateTable"""
+	if isinstance(key, str):
+		key = key.encode()
+	value = int.from_bytes(blake2b(key, digest_size=8).digest(), 'little')
+	return value if value > _DELETED_KEY else value + 2
+
+class SharedStateTable():
+	"""A fixed size table of integer states keyed by the 64 bit hash of a str
+	or bytes key, stored in shared memory.
+
+	Processes forked after the table was created read and write it directly.
+	Writers serialize on a lock; readers take no lock but retry when the
+	sequence counter of a slot shows it changed under them. Two keys with the
+	same 64 bit hash share a state."""
+	def __init__(self, size=STATE_TABLE_SIZE):
+		self.size = size
+		self._slots = RawArray(_StateSlot, size)
+		self._lock = Lock()
+
+	def _read(self, index):
+		slot = self._slots[index]
+		while True:
+			seq = slot.seq
+			if not seq & 1:
+				key, state = slot.key, slot.state
+				if slot.seq == seq:
+					return key, state
+			sleep(0)
+
+	def _write(self, index, key, state):
+		slot = self._slots[index]
+		slot.seq += 1
+		slot.key = key
+		slot.state = state
+		slot.seq += 1
+
+	def _probe(self, hkey):
+		start = hkey % self.size
+		for i in range(self.size):
+			yield (start + i) % self.size
+
+	def _find(self, hkey):
+		"""Returns the index and state of the slot of hkey, or (None, None)"""
+		for index in self._probe(hkey):
+			key, state = self._read(index)
+			if key == hkey:
+				return index, state
+			if key == _EMPTY_KEY:
+				break
+		return None, None
+
+	def get(self, key, default=None):
+		index, state = self._find(state_key(key))
+		return default if index is None else state
+
+	def __getitem__(self, key):
+		index, state = self._find(state_key(key))
+		if index is None:
+			raise KeyError(key)
+		return state
+
+	def __contains__(self, key):
+		return self._find(state_key(key))[0] is not None
+
+	def __setitem__(self, key, state):
+		hkey = state_key(key)
+		with self._lock:
+			free = None
+			for index in self._probe(hkey):
+				slot = self._slots[index]
+				if slot.key == hkey:
+					free = index
+					break
+				if slot.key == _DELETED_KEY and free is None:
+					free = index
+				elif slot.key == _EMPTY_KEY:
+					if free is None:
+						free = index
+					break
+			if free is None:
+				raise StateTableFullException('No free slot for %r' % (key,))
+			self._write(free, hkey, state)
+
+	def discard(self, key):
+		"""Removes the key from the table, if present"""
+		hkey = state_key(key)
+		with self._lock:
+			index, _ = self._find(hkey)
+			if index is not None:
+				self._write(index, _DELETED_KEY, 0)
+
 class AbstractMPBorg(metaclass=ABCMeta):
 	_mutex = ForkAwareThreadLock()
 	def __init__(self, *args, **kwds):
@@ -17,9 +142,9 @@ class AbstractMPBorg(metaclass=ABCMeta):
 				type(self)._shared_state = {}
 			self.__dict__ = self._shared_state
 			if not self.is_initialized():
-				self._manager = Manager()
+				self._manager = shared_manager()
 				self._initialize(*args, **kwds)
-				self.initialized = self._manager.Value(bool, True)
+				self.initialized = True
 		finally:
 			self._mutex.release()
 
@@ -32,103 +157,449 @@ class AbstractMPBorg(metaclass=ABCMeta):
 		pass
 
 SHUTDOWN_WAIT_TIMEOUT = 5
-QUEUE_GRACE_PERIOD = 0.1
+
+# How the consumers of an AbstractQueueConsumer are run. PROCESS forks a
+# process per consumer fed through a manager queue. THREAD runs them as
+# threads on an in-process queue, so records are never pickled. ASYNCIO runs
+# them as tasks on an event loop in a thread of its own, the record handler
+# may then be a coroutine function.
+Backend = enum(PROCESS='process', THREAD='thread', ASYNCIO='asyncio')
+
+# What a producer does when the queue of an AbstractQueueConsumer is full.
+# BLOCK waits up to put_timeout seconds and raises queue.Full after dropping
+# the record. DROP_OLDEST makes room by dropping the oldest queued record,
+# DROP_NEWEST drops the record being put. SAMPLE, meant for logs, only keeps
+# one record in sample_every once the queue is half full, and drops records
+# that find it full.
+Overflow = enum(BLOCK='block', DROP_OLDEST='drop_oldest',
+			DROP_NEWEST='drop_newest', SAMPLE='sample')
+
+class _Outstanding():
+	"""Counts the records put on a queue that were not handled yet, and wakes
+	up the threads or processes waiting for the count to drop to zero.
+
+	It also keeps the highest count seen and the number of dropped records."""
+	def __init__(self, shared):
+		# Outstanding, high-water mark and dropped counts
+		self._counts = RawArray(c_int64, 3)
+		if shared:
+			self._cond = multiprocessing.Condition()
+		else:
+			self._cond = threading.Condition()
+
+	@property
+	def value(self):
+		return self._counts[0]
+
+	@property
+	def high_water(self):
+		return self._counts[1]
+
+	@property
+	def dropped(self):
+		return self._counts[2]
+
+	def add(self):
+		with self._cond:
+			self._counts[0] += 1
+			if self._counts[0] > self._counts[1]:
+				self._counts[1] = self._counts[0]
+
+	def done(self, dropped=False):
+		with self._cond:
+			self._counts[0] -= 1
+			if dropped:
+				self._counts[2] += 1
+			if self._counts[0] <= 0:
+				self._cond.notify_all()
+
+	def wait(self, timeout=None):
+		"""Waits till all records are handled. Returns False on timeout."""
+		with self._cond:
+			return self._cond.wait_for(lambda: self._counts[0] <= 0, timeout)
+
+# Histograms have log2 buckets of microseconds: bucket 0 counts durations
+# under 1us, bucket i those under 2**i us, the last bucket everything longer
+STATS_BUCKETS = 32
+STATS_DUMP_INTERVAL = 60
+
+def _bucket(seconds):
+	return min(STATS_BUCKETS - 1, int(seconds * 1e6).bit_length())
+
+def _histogram(counts, total_ns):
+	"""Summarizes histogram bucket counts. Percentiles are the upper bound of
+	the bucket they fall in, in seconds."""
+	count = sum(counts)
+	summary = {'count': count, 'buckets': list(counts),
+			'mean': total_ns / count / 1e9 if count else 0}
+	for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]:
+		seen, value = 0, 0
+		for i, n in enumerate(counts):
+			seen += n
+			if count and seen >= fraction * count:
+				value = (1 << i) / 1e6
+				break
+		summary[name] = value
+	return summary
+
+class _ConsumerStats():
+	"""Counters of each consumer, in shared memory so that forked consumers
+	report to the process that owns the queue. A consumer only writes its own
+	row, so the hot path takes no lock."""
+	# Row layout: processed, queue latency and handler duration totals in
+	# nanoseconds, then the latency and the duration histograms
+	_width = 3 + 2 * STATS_BUCKETS
+
+	def __init__(self, consumers):
+		self._rows = RawArray(c_int64, consumers * self._width)
+
+	def record(self, cid, latency, duration):
+		base = cid * self._width
+		rows = self._rows
+		rows[base] += 1
+		rows[base + 1] += int(latency * 1e9)
+		rows[base + 2] += int(duration * 1e9)
+		rows[base + 3 + _bucket(latency)] += 1
+		rows[base + 3 + STATS_BUCKETS + _bucket(duration)] += 1
+
+	def snapshot(self, cids):
+		"""Returns the counters of the given consumers, summed"""
+		row = [0] * self._width
+		for cid in cids:
+			base = cid * self._width
+			for i, value in enumerate(self._rows[base:base + self._width]):
+				row[i] += value
+		return {
+			'processed': row[0],
+			'latency': _histogram(row[3:3 + STATS_BUCKETS], row[1]),
+			'handler': _histogram(row[3 + STATS_BUCKETS:], row[2]),
+			}
 
 class AbstractQueueConsumer(AbstractMPBorg):
-	def __init__(self, consumers, *args, **kwds):
-		AbstractMPBorg.__init__(self, consumers, *args, **kwds)
+	# The class defaults, backend, queue_size and overflow can be overridden
+	# per instance. A queue_size of 0 leaves the queue unbounded.
+	backend = Backend.PROCESS
+	queue_size = 0
+	overflow = Overflow.BLOCK
+	put_timeout = None
+	sample_every = 10
+	# Hooks consumers start with, see add_hook()
+	hooks = ()
+
+	def __init__(self, consumers, backend=None, queue_size=None, overflow=None,
+			*args, **kwds):
+		AbstractMPBorg.__init__(self, consumers, backend, queue_size, overflow,
+							*args, **kwds)
 
 	@property
 	def queue(self):
 		return self._queue
 
-	def _initialize(self, consumers):
+	def _initialize(self, consumers, backend=None, queue_size=None,
+				overflow=None):
 		"""Internal method to initialize all global variables. This initializes
 		the manager, queue, pool and trigger the consumer.
 
 		If additional initializations need to be done, implentor can overwrite
 		this method. Note that this should be called after additional
 		initializations are performed."""
+		if backend is not None:
+			self.backend = backend
+		if queue_size is not None:
+			self.queue_size = queue_size
+		if overflow is not None:
+			self.overflow = overflow
+		self._sampled = 0
 		self._terminator = 'TERMINATE'.encode() + urandom(10)
-		self._queue = self._manager.Queue(-1)
+		# Forked consumers acknowledge records from other processes
+		self._outstanding = _Outstanding(self.backend == Backend.PROCESS)
+		if self.backend == Backend.PROCESS:
+			self._queue = self._manager.Queue(self.queue_size)
+		elif self.backend in (Backend.THREAD, Backend.ASYNCIO):
+			# Thread safe, so producers apply the overflow policy themselves
+			# with the ASYNCIO backend too, and wake the loop up
+			if self.queue_size > 0:
+				self._queue = Queue(self.queue_size)
+			else:
+				self._queue = SimpleQueue()
+			self._wakeup_pending = False
+		else:
+			raise ValueError('Unknown backend %r' % (self.backend,))
 		self._consumers = consumers
+		self._stats = _ConsumerStats(consumers)
+		self._hooks = list(self.hooks)
+		self._dump_stop = None
 		self._start_consumers(self._consumers)
 
 	def shutdown(self, timeout=SHUTDOWN_WAIT_TIMEOUT):
-		"""Kick starts the shut-down process for the class"""
+		"""Stops the consumers once they handled every record put before the
+		call, waiting at most timeout seconds in total (forever if None)."""
+		self.stop_stats_dump()
 		self._stop_consumers(timeout)
-		if self._process.is_alive():
-			# We kill the process if it did not agree to die
-			self._process.terminate()
-			if not self.queue.empty():
-				msg = 'Killed log consumer with messages still in queue.'
-				print(type(self), msg)
+		alive = [ w for w in self._workers if w.is_alive() ]
+		if alive:
+			if self.backend == Backend.PROCESS:
+				# We kill the processes that did not agree to die
+				for worker in alive:
+					worker.terminate()
+			# Threads cannot be killed, they die with the interpreter
+			print(type(self), 'Stopped %d consumers with %d records unhandled.'
+					% (len(alive), self._outstanding.value))
+
+	def flush(self, timeout=None):
+		"""Waits till every record put so far is handled, without stopping
+		the consumers. Returns False if timeout seconds passed first."""
+		return self._outstanding.wait(timeout)
 
 	def blocking_flush(self):
-		"""Process all contents as if shutting down, and restart consumers"""
-		self.shutdown(None)
-		self._start_consumers(self._consumers)
+		"""Waits till every record put so far is handled"""
+		self.flush()
+
+	def queue_stats(self):
+		"""Returns the queue capacity (0 if unbounded), the records outstanding
+		(queued or being handled), their high-water mark and the number of
+		records dropped by the overflow policy."""
+		return {
+			'capacity': self.queue_size,
+			'outstanding': self._outstanding.value,
+			'high_water': self._outstanding.high_water,
+			'dropped': self._outstanding.dropped,
+			}
+
+	def stats(self):
+		"""Returns a snapshot of the instrumentation of the consumers: the
+		queue_stats(), the current queue depth, and the records processed with
+		histograms of their queue latency (from put to handling) and handler
+		duration, for all consumers and for each of them."""
+		snapshot = self.queue_stats()
+		snapshot['depth'] = self.queue.qsize()
+		snapshot.update(self._stats.snapshot(range(self._consumers)))
+		snapshot['consumers'] = [ self._stats.snapshot([cid])
+								for cid in range(self._consumers) ]
+		return snapshot
+
+	def add_hook(self, hook):
+		"""Registers hook(cid, record, latency, duration) to be called by the
+		consumers after each record is handled.
+
+		PROCESS consumers are started along with the instance, so their hooks
+		are set in the hooks class attribute instead, and adding one raises
+		RuntimeError."""
+		if self.backend == Backend.PROCESS:
+			raise RuntimeError('PROCESS consumers are running, set their '
+							'hooks in the hooks class attribute')
+		self._hooks.append(hook)
+
+	def remove_hook(self, hook):
+		self._hooks.remove(hook)
+
+	def dump_stats(self, interval=STATS_DUMP_INTERVAL, dump=None):
+		"""Calls dump with a stats() snapshot every interval seconds, till
+		stop_stats_dump() or shutdown() is called. The default prints the
+		snapshot as JSON."""
+		self.stop_stats_dump()
+		if dump is None:
+			dump = lambda stats: print(type(self).__name__, json.dumps(stats))
+		stop = self._dump_stop = threading.Event()
+		def dumper():
+			while not stop.wait(interval):
+				dump(self.stats())
+		Thread(target=dumper, daemon=True).start()
+
+	def stop_stats_dump(self):
+		if self._dump_stop is not None:
+			self._dump_stop.set()
+			self._dump_stop = None
 
 	@abstractmethod
 	def _record_handler(self, *args):
 		"""Performs the desired action on the record received."""
 		pass
 
+	def _enqueue(self, item, timeout=None):
+		"""Puts an item on the queue, waiting for room if it is full"""
+		self.queue.put(item, True, timeout)
+		if self.backend == Backend.ASYNCIO:
+			self._wake_loop()
+
 	def _put(self, *args):
-		record = tuple(args)
-		self.queue.put(record)
+		# Stamped to measure its queue latency
+		item = (monotonic(), tuple(args))
+		# Counted before it is queued, so a consumer never acknowledges a
+		# record that was not counted yet
+		self._outstanding.add()
+		if self.queue_size > 0 and self.overflow == Overflow.BLOCK:
+			try:
+				self._enqueue(item, self.put_timeout)
+			except Full:
+				self._outstanding.done(dropped=True)
+				raise
+		elif self.queue_size <= 0:
+			self._enqueue(item)
+		else:
+			self._offer(item)
+			if self.backend == Backend.ASYNCIO:
+				self._wake_loop()
+
+	def _offer(self, item):
+		"""Queues a counted record without waiting, applying the overflow
+		policy if the queue is full."""
+		q = self.queue
+		if self.overflow == Overflow.SAMPLE \
+		and q.qsize() * 2 >= self.queue_size:
+			self._sampled += 1
+			if self._sampled % self.sample_every:
+				self._outstanding.done(dropped=True)
+				return
+		while True:
+			try:
+				q.put_nowait(item)
+				return
+			except Full:
+				if self.overflow != Overflow.DROP_OLDEST:
+					self._outstanding.done(dropped=True)
+					return
+			try:
+				oldest = q.get_nowait()
+			except Empty:
+				continue
+			if self._is_terminator(oldest):
+				# Shutting down, the terminator keeps its place
+				q.put_nowait(oldest)
+				self._outstanding.done(dropped=True)
+				return
+			self._outstanding.done(dropped=True)
+
+	def _handle(self, cid, item):
+		"""Handles a queued record and acknowledges it, even if the handler
+		failed"""
+		stamp, record = item
+		start = monotonic()
+		try:
+			self._record_handler(*record)
+		except Exception:
+			print_exc()
+		finally:
+			self._handled(cid, record, stamp, start)
+
+	def _handled(self, cid, record, stamp, start):
+		"""Accounts for a handled record, then acknowledges it"""
+		latency, duration = start - stamp, monotonic() - start
+		self._stats.record(cid, latency, duration)
+		for hook in self._hooks:
+			try:
+				hook(cid, record, latency, duration)
+			except Exception:
+				print_exc()
+		self._outstanding.done()
 
 	def _start_consumers(self, consumers):
-		"""Starts the requested number of consumers
-
-		The last consumer is marked as the 'sucker', this is the only consumer
-		that will wait for queue to be empty after the terminate message is
-		received.
-		"""
-		for i in range(consumers - 1):
-			p = Process(target=self._consumer, args=(i,))
-			p.start()
-		self._process = Process(target=self._consumer,
-							args=(consumers - 1, True))
-		self._process.start()
+		"""Starts the requested number of consumers.
+
+		With the ASYNCIO backend, all consumers are tasks of a single thread
+		and that thread is the only worker."""
+		if self.backend == Backend.ASYNCIO:
+			self._loop = asyncio.new_event_loop()
+			self._workers = [Thread(target=self._run_loop, args=(consumers,),
+								daemon=True)]
+		elif self.backend == Backend.PROCESS:
+			self._workers = [ Process(target=self._consumer, args=(i,))
+							for i in range(consumers) ]
+		else:
+			self._workers = [ Thread(target=self._consume, args=(i,),
+							daemon=True) for i in range(consumers) ]
+		for worker in self._workers:
+			worker.start()
 
 	def _stop_consumers(self, timeout):
 		"""Stops all consumers by sending as many terminate messages as there
-		are consumers.
+		are consumers. These are queued after every pending record, so each
+		consumer exits once there is no work left for it.
 
-		This method waits till the original process that initiated the consumers
-		finish."""
+		This method waits till all consumers finish, or timeout seconds. If a
+		full queue has no room for the terminate messages in time, the
+		consumers are left running."""
+		deadline = None if timeout is None else monotonic() + timeout
 		for _ in range(self._consumers):
-			self.queue.put(self._terminator)
-		self._process.join(timeout)
+			try:
+				self._enqueue(self._terminator, None if deadline is None
+							else max(0, deadline - monotonic()))
+			except Full:
+				break
+		for worker in self._workers:
+			if deadline is None:
+				worker.join()
+			else:
+				worker.join(max(0, deadline - monotonic()))
 
-	def _consumer(self, cid, sucker=False):
+	def _consumer(self, cid):
 		"""Starts consuming from this instance's queue.
 
 		This functions does nothing	if called once the instance's 'initialized'
-		flag is already set.
-
-		The will block till a new record is received from the queue. If the new
-		record is this instance's terminate key, the function breaks when
-		sucker=False. If sucker is True, the function will wait till all records
-		are consumed."""
+		flag is already set."""
 		if self.is_initialized():
 			return None
-		terminate = False
-		while not ((terminate and sucker and self.queue.empty()) \
-				or (terminate and not sucker)):
-			self._mutex.acquire()
+		self._consume(cid)
+
+	def _is_terminator(self, record):
+		return isinstance(record, bytes) and self._terminator == record
+
+	def _consume(self, cid):
+		"""Consumes from this instance's queue.
+
+		This blocks till a new record is received from the queue, and returns
+		once this instance's terminate key is received."""
+		while True:
+			# No borg lock around the get: it is per process for forked
+			# consumers, and threads blocked on get while holding it would
+			# stall the consumers of every other borg
 			try:
-				record = self.queue.get(True)
+				item = self.queue.get(True)
 			except Empty as _:
 				# We should not get this, but just in case.
-				pass
+				continue
+			if self._is_terminator(item):
+				break
+			self._handle(cid, item)
+
+	def _run_loop(self, consumers):
+		"""Runs the ASYNCIO consumers till each received a terminate message"""
+		asyncio.set_event_loop(self._loop)
+		self._ready = asyncio.Event()
+		tasks = [ self._async_consumer(i) for i in range(consumers) ]
+		try:
+			self._loop.run_until_complete(asyncio.gather(*tasks))
+		finally:
+			self._loop.close()
+
+	def _wake_loop(self):
+		"""Wakes the ASYNCIO consumers up, scheduling at most one wake up at a
+		time however many records are put meanwhile."""
+		if not self._wakeup_pending:
+			self._wakeup_pending = True
+			self._loop.call_soon_threadsafe(self._wake_consumers)
+
+	def _wake_consumers(self):
+		self._wakeup_pending = False
+		self._ready.set()
+
+	async def _async_consumer(self, cid):
+		while True:
+			try:
+				item = self.queue.get_nowait()
+			except Empty:
+				self._ready.clear()
+				await self._ready.wait()
+				continue
+			if self._is_terminator(item):
+				break
+			stamp, record = item
+			start = monotonic()
+			try:
+				result = self._record_handler(*record)
+				if asyncio.iscoroutine(result):
+					await result
+			except Exception:
+				print_exc()
 			finally:
-				self._mutex.release()
-			if isinstance(record, bytes) and self._terminator == record:
-				terminate = True
-				# Allow a grace period
-				if sucker:
-					sleep(QUEUE_GRACE_PERIOD)
-			else:
-				self._record_handler(*record)
+				self._handled(cid, record, stamp, start)
@@ -1,14 +1,86 @@
+import codecs
+import json
+import struct
+import time
 import subprocess
 import os
+import posixpath
+import stat
 import tarfile
 import zipfile
-from re import search, compile
-from tempfile import mkdtemp
+import zlib
+import lzma
+from bisect import bisect_right
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from fnmatch import fnmatchcase
+from tempfile import mkdtemp, TemporaryFile
 from abc import ABCMeta, abstractmethod
-from io import BytesIO
+from io import BytesIO, BufferedReader, RawIOBase
+from shutil import copyfileobj
+from string import ascii_letters
+from threading import Lock, Thread
+from multiprocessing import Pool
+from pyrus import enum
+from pyrus.checksum import algorithms
 
 native_support_os = ['posix']
 
+# Members of at least this size get a parallel extraction task of their own,
+# smaller ones are batched together up to this size.
+PARALLEL_BATCH_BYTES = 8 * 1024 * 1024
+
+COPY_BUF_SIZE = 1024 * 1024
+
+# Sidecar index files are stored next to the tar file with this suffix
+TAR_INDEX_SUFFIX = '.pyrus-idx'
+TAR_INDEX_VERSION = 1
+# Uncompressed bytes between two in-memory gzip inflate checkpoints
+GZIP_CHECKPOINT_SPACING = 4 * 1024 * 1024
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Uncompressed bytes per independently compressed block of parallel streams
+PARALLEL_BLOCK_SIZE = 1024 * 1024
+# Larger members added to a ZipWriter with workers are compressed on the
+# calling thread, smaller ones are read into memory and handed to a worker.
+ZIP_PARALLEL_MEMBER_SIZE = 16 * 1024 * 1024
+# gzip header of a parallel written member: FEXTRA set and a single 'PZ'
+# subfield holding the total size of the member, so that readers can find
+# every member without inflating the ones before it.
+_parallel_gzip_header = struct.Struct('<4sIBBH2sHI')
+
+# Member types accepted by the types filter of iter_members()
+MemberType = enum(FILE='file', DIR='dir', LINK='link')
+
+# Archive types told apart by sniff_archive_type(). The compressed types stand
+# for tar archives compressed that way.
+ArchiveType = enum(ZIP='zip', TAR='tar', GZIP='gz', BZIP2='bz2', XZ='xz',
+				ZSTD='zst')
+
+# Bytes read from the start of a file to sniff its type
+SNIFF_SIZE = 4096
+
+# Types handled by the tarfile module and their tarfile.open() mode suffix
+_tar_modes = {
+	ArchiveType.TAR: '',
+	ArchiveType.GZIP: 'gz',
+	ArchiveType.BZIP2: 'bz2',
+	ArchiveType.XZ: 'xz',
+	}
+
+_zip_magics = (b'PK\x03\x04', b'PK\x05\x06', b'PK\x07\x08')
+
+_compression_magics = [
+	(b'\x1f\x8b', ArchiveType.GZIP),
+	(b'BZh', ArchiveType.BZIP2),
+	(b'\xfd7zXZ\x00', ArchiveType.XZ),
+	(b'\x28\xb5\x2f\xfd', ArchiveType.ZSTD),
+	]
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tbz2',
+				'.tar.xz', '.txz', '.tar.zst', '.tzst')
+
 def bytes_to_bio(filebytes):
 	"""Creates a file like BytesIO object from given filebytes."""
 	assert type(filebytes) is bytes
@@ -21,6 +93,10 @@ def fileobj_to_bio(fileobj):
 	fileobj.seek(0)
 	return bio
 
+def is_seekable(fileobj):
+	"""Checks if the given file object supports random access."""
+	return hasattr(fileobj, 'seekable') and fileobj.seekable()
+
 def file_to_bio(filepath):
 	"""Creates a file like BytesIO object from given file on disk. We retrun an
 	empty BytesIO object if the filepath points to a directory or a link.
@@ -89,14 +165,15 @@ class AbstractArchive(metaclass=ABCMeta):
 
 	def check_unsafe(self):
 		"""If unsafe extractions are not allowed we check filenames in the
-		archives to see if any start with '/' or '..'. This identifies absolute
-		and relative paths"""
+		archives to see if any of them is absolute or leaves the extraction
+		directory once normalized (a/../../x). Links pointing outside are only
+		caught during extraction, see SafeExtractor."""
 		if not self.allow_unsafe_extraction:
 			for filename in self.filelist:
-				if filename.startswith(os.path.sep) or \
-					filename.startswith('..'):
-					raise Exception("Unsafe filename_from_info in archive %s" % \
-								self.filepath)
+				if is_unsafe_name(filename):
+					raise UnsafeArchiveException(
+						"Unsafe filename %r in archive %s" % \
+						(filename, self.filepath))
 
 	def __cleanup(self):
 		"""Cleans up all files in the tempdir and sets the tempdir property
@@ -135,6 +212,9 @@ class AbstractArchive(metaclass=ABCMeta):
 		member.filename to absolute path on disk (if inmemory and force_file_obj
 		are False) or file-like object (if inmemory is True or force_file_obj is
 		True).
+
+		Every member is materialized before returning, use iter_members() to
+		walk large archives lazily.
 		"""
 		return NotImplemented
 
@@ -144,6 +224,62 @@ class AbstractArchive(metaclass=ABCMeta):
 		in the archive."""
 		return NotImplementedError
 
+	def iter_members(self, pattern=None, min_size=None, max_size=None,
+					types=None):
+		"""Lazily yields (info, stream) pairs for the members of the archive in
+		archive order. Only members accepted by the filters are opened, the
+		others are never decompressed. The stream is None for directories and
+		links.
+
+		Each stream is only guaranteed to be readable until the next pair is
+		requested, consume (or copy) it before moving on.
+
+		Keyword arguments:
+		pattern -- glob the member name has to match (default None)
+		min_size -- skip members smaller than this many bytes (default None)
+		max_size -- skip members larger than this many bytes (default None)
+		types -- iterable of MemberType values to accept (default None)
+		"""
+		for info in self._iter_infos():
+			if self.member_matches(info, pattern, min_size, max_size, types):
+				stream = self._open_member(info) if self.is_file(info) else None
+				yield info, stream
+
+	def _iter_infos(self):
+		"""Yields the info objects of the archive in archive order. Backends
+		that can read the index incrementally should override this."""
+		return iter(self.infolist())
+
+	def _open_member(self, info):
+		"""Returns a readable file-like object for a regular file member."""
+		return self.extract(info, True)
+
+	@classmethod
+	def member_type(cls, info):
+		"""Returns the MemberType of the given info object"""
+		if cls.is_dir(info):
+			return MemberType.DIR
+		if cls.is_link(info):
+			return MemberType.LINK
+		return MemberType.FILE
+
+	@classmethod
+	def member_matches(cls, info, pattern=None, min_size=None, max_size=None,
+					types=None):
+		"""Checks if the given info object passes the iter_members() filters.
+		This only looks at the info object, no data is read."""
+		if types is not None and cls.member_type(info) not in types:
+			return False
+		size = cls.size_from_info(info)
+		if min_size is not None and size < min_size:
+			return False
+		if max_size is not None and size > max_size:
+			return False
+		if pattern is not None and \
+			not fnmatchcase(cls.filename_from_info(info), pattern):
+			return False
+		return True
+
 	@staticmethod
 	def is_link(info):
 		"""Checks if the given info object is that of a link"""
@@ -164,16 +300,22 @@ class AbstractArchive(metaclass=ABCMeta):
 		"""Gives the filename stored in this info object"""
 		return info.filename
 
+	@staticmethod
+	def size_from_info(info):
+		"""Gives the uncompressed size stored in this info object"""
+		return info.size
+
 class ZipFile(AbstractArchive):
 	def __init__(self, filepath, fileobj=None, inmemory_processing=True,
 				allow_unsafe_extraction=False):
-		# The ZipFile constructor cannot handle file objects other than
-		# BytesIO for some reason. So enforcing it.
-		if fileobj and not isinstance(fileobj, BytesIO):
+		# The ZipFile constructor needs random access, so only streams that
+		# cannot seek are copied into a BytesIO object.
+		if fileobj and not is_seekable(fileobj):
 			fileobj = fileobj_to_bio(fileobj)
 		arg = fileobj if fileobj else filepath
-		assert zipfile.is_zipfile(arg)
 		self.archive = zipfile.ZipFile(arg)
+		# Kept so that worker processes can open the archive themselves
+		self.source = _worker_source(arg)
 		if fileobj:
 			fileobj.seek(0)
 		AbstractArchive.__init__(self, filepath, inmemory_processing,
@@ -204,7 +346,7 @@ class ZipFile(AbstractArchive):
 			filepath = self.archive.extract(member, self.tempdir)
 			return file_to_bio(filepath) if force_file_obj else filepath
 
-	def extract_all(self, force_file_obj=False):
+	def extract_all(self, force_file_obj=False, workers=1):
 		"""Performs extaction of all files in the current Zip Archive.
 		If inmemory mode is enabled, or if force_file_obj is set to True, we
 		return a dictionary where key is the filename and value is a file-like
@@ -213,19 +355,82 @@ class ZipFile(AbstractArchive):
 		Else if inmemory mode is disabled and force_file_obj is False,, we
 		return a dict with the member name as key and the extracted location of
 		the file on disk as value.
+
+		If workers is greater than 1, members are inflated in parallel by a
+		pool of that many processes. Archives read from a file object that
+		workers cannot open on their own are extracted sequentially.
 		"""
+		if workers > 1 and self.source is not None:
+			return self._parallel_extract_all(force_file_obj, workers)
 		files = {}
 		if self.inmemory:
 			for member in self.infolist():
 				files[member.filename] = self.extract(member)
 		else:
-			self.archive.extractall(self.tempdir)
+			if self.allow_unsafe_extraction:
+				self.archive.extractall(self.tempdir)
+			else:
+				self._safe_extract_all(SafeExtractor(self.tempdir))
 			for member in self.infolist():
 				filepath = os.path.join(self.tempdir, member.filename)
 				value = file_to_bio(filepath) if force_file_obj else filepath
 				files[member.filename] = value
 		return files
 
+	def _safe_extract_all(self, extractor):
+		"""Extracts every member through the given SafeExtractor. Stored
+		members of an archive on disk are copied by the kernel."""
+		fileno = self._fileno()
+		for info in self.infolist():
+			mode = (info.external_attr >> 16) & 0o7777
+			if self.is_dir(info):
+				extractor.make_dir(info.filename)
+			elif self.is_link(info):
+				target = self.archive.read(info).decode()
+				extractor.symlink(info.filename, target)
+			elif fileno is not None and \
+				info.compress_type == zipfile.ZIP_STORED and not \
+				info.flag_bits & 0x01:
+				extractor.copy_range(info.filename, fileno,
+						self._data_offset(info), info.file_size, mode)
+			else:
+				with self.archive.open(info) as stream:
+					extractor.write(info.filename, stream, mode)
+
+	def _fileno(self):
+		"""Gives the file descriptor of the archive if it is a file on disk"""
+		try:
+			return self.archive.fp.fileno()
+		except (AttributeError, OSError, ValueError):
+			return None
+
+	def _data_offset(self, info):
+		"""Gives the offset of the data of a member, which follows its local
+		header"""
+		header = os.pread(self._fileno(), zipfile.sizeFileHeader,
+						info.header_offset)
+		name_length, extra_length = struct.unpack('<HH', header[26:30])
+		return info.header_offset + zipfile.sizeFileHeader + name_length + \
+			extra_length
+
+	def _parallel_extract_all(self, force_file_obj, workers):
+		"""Parallel implementation of extract_all(). Every worker opens the
+		archive once and inflates whole batches of members, writing them to the
+		tempdir or handing the bytes back if we are processing inmemory."""
+		dest = None if self.inmemory else self.tempdir
+		batches = size_batches(self.infolist(), self.size_from_info)
+		files = {}
+		with Pool(workers, _zip_worker_init, (self.source,)) as pool:
+			tasks = [ ([ i.filename for i in batch ], dest) for batch in batches ]
+			for results in pool.imap_unordered(_zip_worker_extract, tasks):
+				for filename, value in results:
+					if self.inmemory:
+						value = bytes_to_bio(value)
+					elif force_file_obj:
+						value = file_to_bio(value)
+					files[filename] = value
+		return files
+
 	@staticmethod
 	def is_link(info):
 		"""This method overrides the implementation in the abstract class
@@ -245,21 +450,94 @@ class ZipFile(AbstractArchive):
 		assert type(info) is zipfile.ZipInfo
 		return info.filename.endswith('/')
 
+	@staticmethod
+	def size_from_info(info):
+		return info.file_size
+
+	def _open_member(self, info):
+		# Streaming straight out of the archive keeps only the decompressor's
+		# buffers in memory, unlike extract() which reads the whole member.
+		return self.archive.open(info)
+
+
+# The archive opened by each worker of ZipFile._parallel_extract_all()
+_worker_zip = None
+
+def _worker_source(source):
+	"""Gives what worker processes open the archive from, or None if they
+	cannot. Forked workers share the offset of an inherited file, so a file
+	object is reopened by its path; an in-memory buffer is copied instead."""
+	if isinstance(source, (str, BytesIO)):
+		return source
+	name = getattr(source, 'name', None)
+	if isinstance(name, str) and os.path.isfile(name):
+		return name
+	return None
+
+def _zip_worker_init(source):
+	global _worker_zip
+	if not isinstance(source, str):
+		source.seek(0)
+	_worker_zip = zipfile.ZipFile(source)
+
+def _zip_worker_extract(task):
+	"""Extracts a batch of members to dest, or reads them if dest is None.
+	Returns a list of (filename, path or bytes)."""
+	filenames, dest = task
+	if dest is None:
+		return [ (f, _worker_zip.read(f)) for f in filenames ]
+	return [ (f, _worker_zip.extract(f, dest)) for f in filenames ]
+
+def size_batches(infos, size_from_info, batch_bytes=PARALLEL_BATCH_BYTES):
+	"""Splits info objects into batches of roughly batch_bytes each, largest
+	first. Members of at least batch_bytes form a batch of their own so that
+	a single huge member cannot hold back the small ones queued behind it."""
+	batches = []
+	current, current_size = [], 0
+	for info in sorted(infos, key=size_from_info, reverse=True):
+		size = size_from_info(info)
+		if size >= batch_bytes:
+			batches.append([info])
+			continue
+		if current and current_size + size > batch_bytes:
+			batches.append(current)
+			current, current_size = [], 0
+		current.append(info)
+		current_size += size
+	if current:
+		batches.append(current)
+	return batches
 
 class TarFile(AbstractArchive):
 	def __init__(self, filepath, fileobj=None, inmemory_processing=True,
-				allow_unsafe_extraction=False):
-		# Risky business, we do not check if this is a valid tarfile
-		# we watch it fail and burn. We do this as we have no reliable check
-		# handling both bytes/name case liek in zipfile.
+				allow_unsafe_extraction=False, index=None, archive_type=None,
+				workers=1):
+		# The archive type selects the decompression directly, so tarfile does
+		# not have to try every compression in turn.
+		head = read_head(fileobj or filepath)
+		if archive_type is None:
+			archive_type = sniff_archive_type(head)
+		assert archive_type in _tar_modes
+		mode = 'r:' + _tar_modes[archive_type]
+		self.reader = None
+		if workers > 1 and archive_type == ArchiveType.GZIP and \
+			is_parallel_gzip(head):
+			# We inflate in parallel ourselves, tarfile reads a plain tar
+			self.reader = ParallelGzipReader(fileobj or filepath, workers)
+			fileobj = self.reader
+			mode = 'r:'
 		if fileobj:
-			self.archive = tarfile.TarFile(fileobj=fileobj)
+			self.archive = tarfile.open(fileobj=fileobj, mode=mode)
 		else:
-			self.archive = tarfile.TarFile(name=filepath)
+			self.archive = tarfile.open(name=filepath, mode=mode)
+		# A TarIndex lets us skip the member scan and seek straight to members
+		self.index = index
 		AbstractArchive.__init__(self, filepath, inmemory_processing,
 								allow_unsafe_extraction)
 
 	def generate_filelist(self):
+		if self.index is not None:
+			return self.index.names()
 		return self.archive.getnames()
 
 	def extract(self, member, force_file_obj=False):
@@ -275,9 +553,17 @@ class TarFile(AbstractArchive):
 		or a link will throw an assertion error.
 		"""
 		if self.inmemory:
+			if self.index is not None:
+				return self.index.open_member(self.filename_from_info(member)
+						if type(member) is tarfile.TarInfo else member)
 			return self.archive.extractfile(member)
 		else:
-			self.archive.extract(member, self.tempdir)
+			if self.allow_unsafe_extraction:
+				self.archive.extract(member, self.tempdir)
+			else:
+				if type(member) is not tarfile.TarInfo:
+					member = self.archive.getmember(member)
+				self._safe_extract(SafeExtractor(self.tempdir), [member])
 			filepath = member.name if type(member) is tarfile.TarInfo else member
 			filepath = os.path.join(self.tempdir, filepath)
 			return file_to_bio(filepath) if force_file_obj else filepath
@@ -295,123 +581,711 @@ class TarFile(AbstractArchive):
 		files = {}
 		if self.inmemory:
 			for member in self.infolist():
-				files[member.filename] = self.extract(member)
+				files[member.name] = self.extract(member)
 		else:
-			self.archive.extractall(self.tempdir)
-			for member in self.filelist:
-				filepath = os.path.join(self.tempdir, member.filename)
+			if self.allow_unsafe_extraction:
+				self.archive.extractall(self.tempdir)
+			else:
+				self._safe_extract(SafeExtractor(self.tempdir), self._iter_infos())
+			for filename in self.filelist:
+				filepath = os.path.join(self.tempdir, filename)
 				value = file_to_bio(filepath) if force_file_obj else filepath
-				files[member.filename] = value
+				files[filename] = value
 		return files
 
+	def _safe_extract(self, extractor, infos):
+		"""Extracts the given members through a SafeExtractor. Data of an
+		uncompressed tar on disk is copied by the kernel."""
+		fileobj = self.archive.fileobj
+		try:
+			fileno = fileobj.fileno() if type(fileobj) is BufferedReader \
+				else None
+		except (AttributeError, OSError):
+			fileno = None
+		for info in infos:
+			if info.isdir():
+				extractor.make_dir(info.name)
+			elif info.issym():
+				extractor.symlink(info.name, info.linkname)
+			elif info.islnk():
+				extractor.hardlink(info.name, info.linkname)
+			elif info.isreg() and fileno is not None and not info.sparse:
+				extractor.copy_range(info.name, fileno, info.offset_data,
+									info.size, info.mode, info.mtime)
+			elif info.isreg():
+				extractor.write(info.name, self.archive.extractfile(info),
+							info.mode, info.mtime)
+
 	def infolist(self):
 		return self.archive.getmembers()
 
+	def _iter_infos(self):
+		# Iterating the TarFile reads headers on demand instead of loading the
+		# complete member list first.
+		return iter(self.archive)
+
+	def _open_member(self, info):
+		return self.archive.extractfile(info)
+
 	@staticmethod
 	def filename_from_info(info):
 		return info.name
 
+	def close(self):
+		"""Closes the archive, and the parallel gzip reader if we use one"""
+		self.archive.close()
+		if self.reader is not None:
+			self.reader.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+
+class TarIndex():
+	"""A random access index for the members of a tar file on disk, plain or
+	gzip compressed. The index maps member names to the offset of their data
+	in the uncompressed tar stream, so a member can be read without scanning
+	the members stored before it.
+
+	For gzip compressed files, decompression can only restart at a checkpoint.
+	The start of every gzip member is a checkpoint that is saved along with the
+	index, which makes multi-member files (pigz --independent, bgzip) fully
+	random access. Single member files also get an in-memory inflate
+	checkpoint every GZIP_CHECKPOINT_SPACING bytes while the index is built.
+	Python's zlib cannot serialize inflate state, so those only last as long as
+	the index object.
+	"""
+	def __init__(self, filepath, members, compression=None, checkpoints=None,
+				states=None):
+		self.filepath = filepath
+		self.members = members
+		self.compression = compression
+		self.checkpoints = checkpoints or [(0, 0)]
+		self.states = states or []
+
+	@staticmethod
+	def index_path(filepath):
+		return filepath + TAR_INDEX_SUFFIX
+
+	@staticmethod
+	def _source_stamp(filepath):
+		st = os.stat(filepath)
+		return [st.st_size, st.st_mtime]
+
+	@classmethod
+	def build(cls, filepath, spacing=GZIP_CHECKPOINT_SPACING):
+		"""Builds the index of the given tar file in a single sequential pass"""
+		with open(filepath, 'rb') as f:
+			compression = 'gzip' if f.read(2) == b'\x1f\x8b' else None
+			f.seek(0)
+			if compression:
+				reader = _GzipCheckpointReader(f, spacing)
+				archive = tarfile.open(fileobj=reader, mode='r|')
+			else:
+				reader = None
+				archive = tarfile.open(fileobj=f, mode='r:')
+			members = {}
+			for info in archive:
+				members[info.name] = [info.offset_data, info.size,
+									info.type.decode(), info.linkname]
+		if reader is None:
+			return cls(filepath, members)
+		return cls(filepath, members, compression, reader.checkpoints,
+				reader.states)
+
+	@classmethod
+	def load(cls, filepath, index_path=None):
+		"""Loads the sidecar index of a tar file. Returns None if there is no
+		index or if it was built for a different version of the file."""
+		index_path = index_path or cls.index_path(filepath)
+		try:
+			with open(index_path) as f:
+				data = json.load(f)
+		except (IOError, ValueError):
+			return None
+		if data.get('version') != TAR_INDEX_VERSION or \
+			data.get('source') != cls._source_stamp(filepath):
+			return None
+		checkpoints = [ tuple(c) for c in data['checkpoints'] ]
+		return cls(filepath, data['members'], data['compression'], checkpoints)
+
+	@classmethod
+	def open(cls, filepath, index_path=None):
+		"""Loads the sidecar index of a tar file, (re)building and saving it
+		if it is missing or stale."""
+		index = cls.load(filepath, index_path)
+		if index is None:
+			index = cls.build(filepath)
+			index.save(index_path)
+		return index
+
+	def save(self, index_path=None):
+		data = {
+			'version': TAR_INDEX_VERSION,
+			'source': self._source_stamp(self.filepath),
+			'compression': self.compression,
+			'checkpoints': self.checkpoints,
+			'members': self.members,
+			}
+		with open(index_path or self.index_path(self.filepath), 'w') as f:
+			json.dump(data, f)
+
+	def names(self):
+		return list(self.members)
+
+	def _resolve(self, name):
+		"""Follows links to the member holding the data. Returns None for
+		members without data such as directories."""
+		for _ in range(len(self.members)):
+			offset, size, member_type, linkname = self.members[name]
+			member_type = member_type.encode()
+			if member_type in tarfile.REGULAR_TYPES:
+				return offset, size
+			if member_type == tarfile.LNKTYPE:
+				name = linkname
+			elif member_type == tarfile.SYMTYPE:
+				name = os.path.normpath(
+						os.path.join(os.path.dirname(name), linkname))
+			else:
+				return None
+			if name not in self.members:
+				return None
+		return None
+
+	def open_member(self, name):
+		"""Returns a BytesIO object with the data of the given member, or None
+		if the member (or its link target) has no data."""
+		location = self._resolve(name)
+		if location is None:
+			return None
+		offset, size = location
+		with open(self.filepath, 'rb') as f:
+			if self.compression is None:
+				f.seek(offset)
+				return BytesIO(f.read(size))
+			reader = self._reader_at(f, offset)
+			return BytesIO(reader.read(size))
+
+	def _reader_at(self, f, offset):
+		"""Returns a gzip reader positioned at the given uncompressed offset,
+		starting from the closest checkpoint before it."""
+		compressed, uncompressed, state = 0, 0, None
+		for c, u in self.checkpoints:
+			if u <= offset and u >= uncompressed:
+				compressed, uncompressed = c, u
+		for u, c, s in self.states:
+			if u <= offset and u > uncompressed:
+				compressed, uncompressed, state = c, u, s
+		f.seek(compressed)
+		reader = _GzipCheckpointReader(f, None, compressed, uncompressed,
+									state.copy() if state else None)
+		reader.skip(offset - uncompressed)
+		return reader
+
+class _GzipCheckpointReader():
+	"""A forward-only reader of gzip data that records restart points while it
+	reads: the start of every gzip member (checkpoints) and, if spacing is
+	set, copies of the inflate state every spacing bytes (states)."""
+	def __init__(self, fileobj, spacing=None, compressed=0, uncompressed=0,
+				state=None):
+		self.fileobj = fileobj
+		self.spacing = spacing
+		self.checkpoints = [(compressed, uncompressed)]
+		self.states = []
+		self._inflate = state or zlib.decompressobj(GZIP_WBITS)
+		self._in = compressed
+		self._out = uncompressed
+		self._buffer = b''
+		self._pos = 0
+		self._next_state = uncompressed + spacing if spacing else None
+
+	def read(self, size=-1):
+		chunks = []
+		while size != 0:
+			if self._pos == len(self._buffer) and not self._fill():
+				break
+			end = len(self._buffer) if size < 0 else self._pos + size
+			chunk = self._buffer[self._pos:end]
+			self._pos += len(chunk)
+			size -= len(chunk) if size > 0 else 0
+			chunks.append(chunk)
+		return b''.join(chunks)
+
+	def skip(self, size):
+		while size > 0:
+			if self._pos == len(self._buffer) and not self._fill():
+				break
+			step = min(size, len(self._buffer) - self._pos)
+			self._pos += step
+			size -= step
+
+	def _fill(self):
+		"""Inflates the next chunk into the buffer. Returns False at EOF."""
+		if self._inflate.eof:
+			data = self._inflate.unused_data
+			if not data:
+				data = self.fileobj.read(COPY_BUF_SIZE)
+				self._in += len(data)
+			if not data.strip(b'\x00'):
+				# End of file, or the zero padding some tools write after it
+				return False
+			self.checkpoints.append((self._in - len(data), self._out))
+			self._inflate = zlib.decompressobj(GZIP_WBITS)
+		else:
+			data = self.fileobj.read(COPY_BUF_SIZE)
+			if not data:
+				return False
+			self._in += len(data)
+		self._buffer = self._inflate.decompress(data)
+		self._pos = 0
+		self._out += len(self._buffer)
+		if self._next_state is not None and self._out >= self._next_state \
+			and not self._inflate.eof:
+			# All input read so far was consumed, so the state copy resumes at
+			# compressed offset _in and uncompressed offset _out
+			self.states.append((self._out, self._in, self._inflate.copy()))
+			self._next_state = self._out + self.spacing
+		return True
+
+class UnsafeArchiveException(Exception): pass
+
+def is_unsafe_name(filename):
+	"""Checks if a member name is absolute (including drive letters and
+	backslashes) or climbs out of the extraction directory once normalized."""
+	name = filename.replace('\\', '/')
+	if name.startswith('/') or \
+		(name[1:2] == ':' and name[:1] in ascii_letters):
+		return True
+	normalized = posixpath.normpath(name)
+	return normalized == '..' or normalized.startswith('../')
+
+def _is_inside(path, root):
+	return path == root or path.startswith(root + os.sep)
+
+class SafeExtractor():
+	"""Writes archive members below root, checking every member in the same
+	pass. Names are checked after normalization, link targets and the
+	directories files are written to are checked after resolving symlinks, so
+	neither a/../../x nor a symlink extracted earlier can lead outside root.
+
+	A '..' in a link target may only climb out of directories that already
+	exist and are not links. Those cannot be replaced by a later member, so
+	the link cannot be made to point elsewhere once it was checked.
+
+	Directories that were checked are remembered, which makes creating and
+	checking them a one time cost per directory."""
+	def __init__(self, root):
+		self.root = os.path.realpath(root)
+		self.dirs = set([self.root])
+
+	def _path(self, name):
+		"""Gives the path of a member, creating and checking its parents"""
+		if is_unsafe_name(name):
+			raise UnsafeArchiveException("Unsafe filename %r" % name)
+		path = os.path.normpath(os.path.join(self.root, name))
+		self._make_dirs(os.path.dirname(path))
+		return path
+
+	def _make_dirs(self, path):
+		if path in self.dirs:
+			return
+		self._make_dirs(os.path.dirname(path))
+		try:
+			os.mkdir(path)
+		except FileExistsError:
+			# Could be a symlink extracted earlier, resolve it
+			if not _is_inside(os.path.realpath(path), self.root) or \
+				not os.path.isdir(path):
+				raise UnsafeArchiveException("Unsafe directory %r" % path)
+		self.dirs.add(path)
+
+	def make_dir(self, name):
+		if not name.strip('/'):
+			return
+		self._make_dirs(self._path(name.rstrip('/')))
+
+	def symlink(self, name, target):
+		path = self._path(name)
+		resolved = os.path.realpath(os.path.join(os.path.dirname(path), target))
+		if os.path.isabs(target) or not _is_inside(resolved, self.root) or \
+			not self._stable_climb(os.path.dirname(path), target):
+			raise UnsafeArchiveException("Unsafe link %r -> %r" % (name, target))
+		self._remove(path)
+		os.symlink(target, path)
+		# A new link can change where any checked directory resolves to
+		self.dirs = set([self.root])
+
+	@staticmethod
+	def _stable_climb(directory, target):
+		"""Checks that every '..' of target, followed from directory, leaves a
+		directory that exists and is not a link"""
+		# The link itself lives in the resolved directory for good
+		current, stable = os.path.realpath(directory), True
+		for part in target.split('/'):
+			if part == '..':
+				if not stable:
+					return False
+				current = os.path.dirname(current)
+			elif part not in ('', '.'):
+				current = os.path.join(current, part)
+				stable = stable and os.path.isdir(current) and \
+					not os.path.islink(current)
+		return True
+
+	def hardlink(self, name, target):
+		path = self._path(name)
+		source = self._path(target)
+		if not _is_inside(os.path.realpath(source), self.root):
+			raise UnsafeArchiveException("Unsafe link %r -> %r" % (name, target))
+		self._remove(path)
+		os.link(source, path)
+
+	def _remove(self, path):
+		if os.path.lexists(path) and not os.path.isdir(path):
+			os.unlink(path)
+
+	def _open(self, name, mode):
+		"""Opens the file of a member for writing, never following a symlink
+		already in its place. Returns the file descriptor and the path."""
+		path = self._path(name)
+		flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | \
+			getattr(os, 'O_NOFOLLOW', 0)
+		try:
+			return os.open(path, flags, mode & 0o7777 or 0o644), path
+		except OSError:
+			self._remove(path)
+			return os.open(path, flags, mode & 0o7777 or 0o644), path
+
+	def _finish(self, fd, path, mode, mtime):
+		if mode:
+			os.fchmod(fd, mode & 0o7777)
+		os.close(fd)
+		if mtime is not None:
+			os.utime(path, (mtime, mtime))
+
+	def write(self, name, stream, mode=0, mtime=None):
+		"""Writes a member from a stream using large buffers"""
+		fd, path = self._open(name, mode)
+		try:
+			with open(fd, 'wb', closefd=False) as dest:
+				copyfileobj(stream, dest, COPY_BUF_SIZE)
+		finally:
+			self._finish(fd, path, mode, mtime)
+
+	def copy_range(self, name, fileno, offset, size, mode=0, mtime=None):
+		"""Writes a member stored uncompressed at offset in the file fileno,
+		letting the kernel copy the data when possible."""
+		fd, path = self._open(name, mode)
+		try:
+			copied = _copy_range(fileno, fd, offset, size)
+			while copied < size:
+				chunk = os.pread(fileno, min(size - copied, COPY_BUF_SIZE),
+								offset + copied)
+				if not chunk:
+					raise EOFError('Unexpected end of archive data')
+				copied += os.write(fd, chunk)
+		finally:
+			self._finish(fd, path, mode, mtime)
+
+def _copy_range(src, dest, offset, size):
+	"""Copies size bytes at offset of src to dest in the kernel with
+	copy_file_range or sendfile. Returns the number of bytes copied, which
+	is less than size if neither is available."""
+	copied = 0
+	try:
+		while copied < size:
+			if hasattr(os, 'copy_file_range'):
+				count = os.copy_file_range(src, dest, size - copied,
+										offset + copied)
+			else:
+				count = os.sendfile(dest, src, offset + copied, size - copied)
+			if not count:
+				break
+			copied += count
+	except (AttributeError, OSError):
+		# Not supported by the platform or these file systems
+		pass
+	return copied
 
 class AbstractNativeArchive(AbstractArchive):
 	@staticmethod
 	def is_native():
 		return True
 
+# tar cannot detect the compression when reading the archive from stdin, these
+# options select it.
+_native_compression_flags = {
+	ArchiveType.GZIP: ['-z'],
+	ArchiveType.BZIP2: ['-j'],
+	ArchiveType.XZ: ['-J'],
+	ArchiveType.ZSTD: ['--zstd'],
+	}
+
 class NativeTarFile(AbstractNativeArchive):
+	"""Tar archive handled by the tar command. A fileobj is piped into tar over
+	stdin, so it is read once per tar invocation. Every invocation reads it at
+	its own offset, so streams returned by extract() can be read in any order
+	while this instance owns the fileobj."""
 	def __init__(self, filepath, fileobj=None, inmemory_processing=False,
-				allow_unsafe_extraction=False):
-		# Native archives cannot support inmemory mode
-		self.inmemory_processing = False
+				allow_unsafe_extraction=False, archive_type=None):
 		self.path = filepath
-		if fileobj:
-			temp_path = os.path.join(mkdtemp(prefix='nativetar-'), filepath)
-			os.makedirs(os.path.dirname(temp_path))
-			with open(temp_path, 'wb') as f:
-				f.write(fileobj.read())
-				fileobj.seek(0)
-			self.path = temp_path
+		self.fileobj = fileobj
+		if fileobj and not is_seekable(fileobj):
+			# Every tar invocation reads the archive again, so a stream we
+			# cannot rewind has to be copied once.
+			self.fileobj = TemporaryFile()
+			copyfileobj(fileobj, self.fileobj, COPY_BUF_SIZE)
+		# Feeders of concurrent tar invocations take turns on the fileobj
+		self._feed_lock = Lock()
+		self.compression_flags = []
+		if self.fileobj:
+			if archive_type is None:
+				self.fileobj.seek(0)
+				archive_type = sniff_archive_type(read_head(self.fileobj))
+			self.compression_flags = \
+					_native_compression_flags.get(archive_type, [])
 		assert os.name in native_support_os
 		AbstractArchive.__init__(self, filepath, inmemory_processing,
 								allow_unsafe_extraction)
 
-	def __del__(self):
-		from shutil import rmtree
-		path = self.path.replace(self.filepath)
-		if os.path.exists(path):
-			rmtree(path)
-
 	@property
 	def extract_cmd(self):
-		return ['tar', '-C', self.tempdir, '-xf', self.path]
+		return ['tar', '-C', self.tempdir, '-xf', self.source]
+
+	@property
+	def source(self):
+		"""The archive argument given to tar, '-' when piping the fileobj"""
+		return '-' if self.fileobj else self.path
+
+	def _pipe(self, args, members=()):
+		"""Runs tar with the given arguments on this archive and returns its
+		stdout as a buffered file-like object. The fileobj, if any, is written
+		to tar's stdin by a separate thread."""
+		cmd = ['tar'] + self.compression_flags + args + ['-f', self.source]
+		if members:
+			cmd += ['--'] + list(members)
+		# The C locale keeps the listing columns in a known shape
+		env = dict(os.environ, LC_ALL='C')
+		stdin = subprocess.PIPE if self.fileobj else None
+		proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+							env=env)
+		feeder = None
+		if self.fileobj:
+			feeder = Thread(target=self._feed, args=(proc.stdin,))
+			feeder.daemon = True
+			feeder.start()
+		return BufferedReader(_TarPipe(cmd, proc, feeder), COPY_BUF_SIZE)
+
+	def _feed(self, stdin):
+		offset = 0
+		try:
+			while True:
+				with self._feed_lock:
+					self.fileobj.seek(offset)
+					chunk = self.fileobj.read(COPY_BUF_SIZE)
+				if not chunk:
+					break
+				offset += len(chunk)
+				stdin.write(chunk)
+		except (BrokenPipeError, ValueError):
+			# tar stopped reading early, or the pipe was closed under us
+			pass
+		finally:
+			try:
+				stdin.close()
+			except BrokenPipeError:
+				pass
 
 	def prepare_info(self):
 		"""This method prepares additional information including file
 		permissions, link information etc for later use. Here we make use of
-		the output provided by the command tar -tvf. The additional information
-		is stored in __infolist as NativeInfo objects"""
-		# We expect the format:
-		# permissions owner/group size date time filename_from_info
-		regex = compile('([dlrwx-]*) [ ]*([a-zA-Z0-9/]*) [ ]*([0-9]*) ' +
-					'[ ]*([0-9-]*) [ ]*([0-9:]*) [ ]*(.*)')
-		cmd = ['tar', '-tvf', self.path]
-		output = subprocess.check_output(cmd)
+		the output provided by the command tar -tvf, which is parsed line by line
+		as tar produces it. The additional information is stored in __infolist
+		as NativeInfo objects"""
 		self.__infolist = []
 		filelist = []
-		for line in output.decode().strip().split('\n'):
-			match = search(regex, line)
-			if match:
-				filename = match.group(6).strip()
-				linkto = None
-				if filename.find('->') >= 0:
-					filename, linkto = [ i.strip()
-									for i in filename.split('->')]
-				permissions = match.group(1)
-				owner, group = match.group(2).split('/')
-				filesize = int(match.group(3))
-				self.__infolist.append(NativeInfo(filename, permissions,
-								owner, group, filesize, linkto))
-				filelist.append(filename)
+		with self._pipe(['--quoting-style=c', '--numeric-owner', '-tv']) as out:
+			for line in out:
+				info = NativeInfo.from_listing(line)
+				self.__infolist.append(info)
+				filelist.append(info.filename_from_info)
 		return filelist
 
 	def generate_filelist(self):
 		return self.prepare_info()
 
 	def generate_simple_filelist(self):
-		cmd = ['tar', '-tf', self.path]
-		files = subprocess.check_output(cmd)
+		with self._pipe(['-t']) as out:
+			files = out.read()
 		return [ f.strip() for f in files.decode().strip().split('\n') ]
 
 	def extract(self, member=None, force_file_obj=False):
-		cmd = self.extract_cmd
-		path = self.tempdir
-		if member:
-			if type(member) is NativeInfo:
-				filename = member.filename_from_info
-			else:
-				filename = member
-			assert filename in self.filelist
-			cmd.append(filename)
-			path = os.path.join(path, filename)
+		"""Extracts a member, or all members if member is None, to the tempdir
+		and returns its path. If inmemory mode is enabled, or if force_file_obj
+		is set to True, the member is instead streamed out of tar -xO and a
+		file-like object reading from the pipe is returned."""
+		if member is None:
+			return self.extract_all(force_file_obj)
+		filename = self.filename_from_info(member) \
+				if type(member) is NativeInfo else member
+		assert filename in self.filelist
+		if self.inmemory or force_file_obj:
+			return self._pipe(['-xO'], [filename])
 		try:
-			subprocess.call(cmd)
-			if not member:
-				values = []
-				for filename in self.filelist:
-					filepath = os.path.join(path, filename)
-					value = file_to_bio(filepath) if force_file_obj else filepath
-					values.append(value)
-				return values
-			return path
+			with self._pipe(['-C', self.tempdir, '-x'], [filename]) as out:
+				out.read()
+			return os.path.join(self.tempdir, filename)
 		except subprocess.CalledProcessError:
 			return None
 
 	def extract_all(self, force_file_obj=False):
-		return self.extract(None, force_file_obj)
+		"""Extracts all members. Returns a list of paths in the tempdir, or of
+		file-like objects if inmemory mode is enabled or force_file_obj is set
+		to True. The file-like objects are cut out of a single tar -xO stream
+		using the sizes from the listing, links get the data of their target."""
+		if self.inmemory or force_file_obj:
+			data = {}
+			with self._pipe(['-xO']) as out:
+				for info in self.infolist():
+					if info.permissions.startswith('-'):
+						data[info.filename_from_info] = out.read(info.filesize)
+			values = []
+			for info in self.infolist():
+				target = self._link_target(info)
+				values.append(BytesIO(data.get(target, b'')))
+			return values
+		try:
+			with self._pipe(['-C', self.tempdir, '-x']) as out:
+				out.read()
+		except subprocess.CalledProcessError:
+			return None
+		return [ os.path.join(self.tempdir, f) for f in self.filelist ]
+
+	@staticmethod
+	def _link_target(info):
+		"""Gives the member name holding the data of the given info object"""
+		if info.islnk():
+			return info.linkto
+		if info.issym():
+			return os.path.normpath(os.path.join(
+						os.path.dirname(info.filename_from_info), info.linkto))
+		return info.filename_from_info
+
+	def iter_members(self, pattern=None, min_size=None, max_size=None,
+					types=None):
+		"""Lazily yields (info, stream) pairs like AbstractArchive.iter_members()
+		does, reading all data from a single tar -xO stream. As tar writes every
+		regular file to that stream, skipped members are still decompressed."""
+		with self._pipe(['-xO']) as out:
+			for info in self.infolist():
+				stream = None
+				if info.permissions.startswith('-'):
+					stream = _BoundedReader(out, info.filesize)
+				if self.member_matches(info, pattern, min_size, max_size,
+									types):
+					yield info, stream if self.is_file(info) else None
+				if stream is not None:
+					stream.skip()
 
 	def infolist(self):
 		return self.__infolist
 
+	@staticmethod
+	def filename_from_info(info):
+		return info.filename_from_info
+
+	@staticmethod
+	def size_from_info(info):
+		return info.filesize
+
+class _TarPipe(RawIOBase):
+	"""The stdout of a running tar command. Reaching EOF waits for tar and
+	raises CalledProcessError if it failed. Closing early stops tar."""
+	def __init__(self, cmd, proc, feeder):
+		self.cmd = cmd
+		self.proc = proc
+		self.feeder = feeder
+
+	def readable(self):
+		return True
+
+	def readinto(self, buf):
+		count = self.proc.stdout.readinto(buf)
+		if not count:
+			returncode = self._wait()
+			if returncode:
+				raise subprocess.CalledProcessError(returncode, self.cmd)
+		return count
+
+	def _wait(self):
+		self.proc.stdout.close()
+		returncode = self.proc.wait()
+		if self.feeder is not None:
+			self.feeder.join()
+		return returncode
+
+	def close(self):
+		if not self.closed:
+			self._wait()
+		RawIOBase.close(self)
+
+class _BoundedReader():
+	"""Reads at most size bytes from a shared stream"""
+	def __init__(self, stream, size):
+		self.stream = stream
+		self.remaining = size
+
+	def read(self, size=-1):
+		if size is None or size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.stream.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def skip(self):
+		while self.remaining and self.read(COPY_BUF_SIZE):
+			pass
+
+# File type characters of the tar -tv permission column and their mode bits
+_listing_types = {
+	'-': stat.S_IFREG, 'h': stat.S_IFREG, 'd': stat.S_IFDIR,
+	'l': stat.S_IFLNK, 'c': stat.S_IFCHR, 'b': stat.S_IFBLK,
+	'p': stat.S_IFIFO, 's': stat.S_IFSOCK,
+	}
+
+# Permission bits in the order of the 9 rwx characters
+_listing_permissions = [
+	stat.S_IRUSR, stat.S_IWUSR, stat.S_IXUSR,
+	stat.S_IRGRP, stat.S_IWGRP, stat.S_IXGRP,
+	stat.S_IROTH, stat.S_IWOTH, stat.S_IXOTH,
+	]
+
+# Bits set by s/S or t/T in the execute positions
+_listing_specials = {2: stat.S_ISUID, 5: stat.S_ISGID, 8: stat.S_ISVTX}
+
+def _unquote_listing(line, start):
+	"""Parses the C-quoted string starting at line[start] (as printed by
+	tar --quoting-style=c). Returns the unquoted bytes and the index just past
+	the closing quote."""
+	assert line[start:start + 1] == b'"'
+	end = start + 1
+	while True:
+		end = line.index(b'"', end)
+		# The quote is escaped if preceded by an odd number of backslashes
+		quoted = line[start + 1:end]
+		if (len(quoted) - len(quoted.rstrip(b'\\'))) % 2 == 0:
+			break
+		end += 1
+	value = codecs.escape_decode(line[start + 1:end])[0]
+	return value, end + 1
+
 class NativeInfo():
+	__slots__ = ['filename_from_info', 'permissions', 'owner', 'group',
+				'filesize', 'linkto']
+
 	def __init__(self, filename, permissions, owner, group, filesize, linkto=None):
 		self.filename_from_info = filename
 		self.permissions = permissions
@@ -420,60 +1294,798 @@ class NativeInfo():
 		self.filesize = filesize
 		self.linkto = linkto
 
+	@classmethod
+	def from_listing(cls, line):
+		"""Creates a NativeInfo object from a line (bytes) of
+		tar --quoting-style=c --numeric-owner -tv output:
+		permissions owner/group size date time "name" [-> "target"]"""
+		permissions, ownership, size, _, _, rest = line.split(None, 5)
+		owner, group = ownership.decode().split('/', 1)
+		# Devices list major,minor instead of a size
+		filesize = 0 if b',' in size else int(size)
+		filename, end = _unquote_listing(rest, 0)
+		linkto = None
+		for separator in (b' -> ', b' link to '):
+			if rest.startswith(separator, end):
+				linkto = os.fsdecode(_unquote_listing(rest, end + len(separator))[0])
+				break
+		return cls(os.fsdecode(filename), permissions.decode(), owner, group,
+				filesize, linkto)
+
+	@property
+	def mode(self):
+		"""The file type and permission bits as found in st_mode"""
+		mode = _listing_types.get(self.permissions[0], stat.S_IFREG)
+		for i, char in enumerate(self.permissions[1:10]):
+			if char in 'rwxst':
+				mode |= _listing_permissions[i]
+			if char in 'sStT':
+				mode |= _listing_specials[i]
+		return mode
+
 	def issym(self):
 		return self.permissions.startswith('l')
 
+	def islnk(self):
+		return self.permissions.startswith('h')
+
 	def isdir(self):
 		return self.permissions.startswith('d')
 
+class AbstractArchiveWriter(metaclass=ABCMeta):
+	"""Writer side of AbstractArchive. Members are added from streams, and
+	members of an existing archive of the same kind are copied without being
+	recompressed.
+
+	Writers are context managers, the archive is complete once close() was
+	called.
+	"""
+	def __init__(self, filepath, fileobj=None, level=None, workers=1):
+		self.filepath = filepath
+		self.fileobj = fileobj
+		self.level = level
+		self.workers = workers
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	@abstractmethod
+	def add_stream(self, name, stream, size=None):
+		"""Adds a regular file member named name with the contents read from
+		stream. Writers that need the size upfront spool the stream if size is
+		not given."""
+		return NotImplemented
+
+	@abstractmethod
+	def add_dir(self, name):
+		"""Adds a directory member"""
+		return NotImplemented
+
+	@abstractmethod
+	def close(self):
+		"""Finishes the archive and closes the file if we opened it"""
+		return NotImplemented
+
+	def add_file(self, path, name=None):
+		"""Adds the file on disk at path as member name. The default name is
+		path made relative, like tar and zip do: without a drive, leading
+		slashes or leading '..' components."""
+		with open(path, 'rb') as f:
+			self.add_stream(name or member_name(path), f,
+						os.fstat(f.fileno()).st_size)
+
+	def add_bytes(self, name, data):
+		self.add_stream(name, BytesIO(data), len(data))
+
+	def copy_member(self, archive, info):
+		"""Copies a member of an AbstractArchive into this archive. Links have
+		no representation shared by all archive types and are skipped, writers
+		override this to copy members of their own kind as they are."""
+		name = archive.filename_from_info(info)
+		if archive.is_dir(info):
+			self.add_dir(name)
+		elif archive.is_file(info):
+			stream = archive._open_member(info)
+			self.add_stream(name, stream, archive.size_from_info(info))
+
+	def copy_members(self, archive, **filters):
+		"""Copies the members of an AbstractArchive accepted by the filters
+		(see AbstractArchive.iter_members()) into this archive. Members are
+		selected by their info objects, skipped members are never read."""
+		for info in archive._iter_infos():
+			if archive.member_matches(info, **filters):
+				self.copy_member(archive, info)
+
+def member_name(path):
+	"""Gives the relative member name a path on disk is stored as"""
+	name = os.path.normpath(os.path.splitdrive(path)[1]).replace(os.sep, '/')
+	parts = name.split('/')
+	while parts and parts[0] in ('', '.', '..'):
+		parts.pop(0)
+	return '/'.join(parts)
+
+def _raw_writes_supported(archive):
+	"""Checks that the zipfile internals ZipWriter._write_raw() relies on are
+	there. They are on CPython 3.6 up to at least 3.13."""
+	return hasattr(zipfile, '_strip_extra') and all(hasattr(archive, attr)
+		for attr in ('_lock', '_seekable', '_writecheck', '_didModify',
+					'start_dir'))
+
+def _deflate(data, level):
+	"""Raw deflate of a member for ZipWriter. Returns the compressed data, the
+	CRC and the uncompressed size."""
+	if level is None:
+		level = zlib.Z_DEFAULT_COMPRESSION
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush(), zlib.crc32(data), \
+		len(data)
+
+class ZipWriter(AbstractArchiveWriter):
+	"""Creates zip archives. With more than one worker, deflate compression of
+	added members runs on a thread pool (zlib releases the GIL) while members
+	are still written in the order they were added. Members copied from a
+	ZipFile keep their compressed data as it is.
+
+	Members handed to workers are read into memory first, at most workers * 2
+	of them of up to ZIP_PARALLEL_MEMBER_SIZE bytes each. Larger members are
+	compressed on the calling thread.
+
+	Writing already compressed data needs zipfile internals. Where those are
+	missing, members are compressed on the calling thread and copied members
+	are recompressed."""
+	def __init__(self, filepath, fileobj=None, level=None, workers=1,
+				compression=zipfile.ZIP_DEFLATED):
+		AbstractArchiveWriter.__init__(self, filepath, fileobj, level, workers)
+		self.compression = compression
+		self.archive = zipfile.ZipFile(fileobj or filepath, 'w', compression,
+									compresslevel=level)
+		self.raw = _raw_writes_supported(self.archive)
+		self.pool = None
+		if workers > 1 and compression == zipfile.ZIP_DEFLATED and self.raw:
+			self.pool = ThreadPoolExecutor(workers)
+		# (ZipInfo, future) of members being compressed, in order
+		self.pending = deque()
+
+	def _new_info(self, name):
+		zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+		zinfo.compress_type = self.compression
+		zinfo.external_attr = 0o644 << 16
+		return zinfo
+
+	def add_stream(self, name, stream, size=None):
+		zinfo = self._new_info(name)
+		if self.pool is not None and (size is None or
+									size <= ZIP_PARALLEL_MEMBER_SIZE):
+			data = stream.read(ZIP_PARALLEL_MEMBER_SIZE + 1)
+			if len(data) <= ZIP_PARALLEL_MEMBER_SIZE:
+				future = self.pool.submit(_deflate, data, self.level)
+				self.pending.append((zinfo, future))
+				self._write_pending(self.workers * 2)
+				return
+			stream = _HeadedStream(data, stream)
+		self._write_pending()
+		# Without a size we cannot tell upfront if ZIP64 is needed
+		force_zip64 = size is None or size > zipfile.ZIP64_LIMIT
+		with self.archive.open(zinfo, 'w', force_zip64=force_zip64) as dest:
+			copyfileobj(stream, dest, COPY_BUF_SIZE)
+
+	def add_dir(self, name):
+		self._write_pending()
+		zinfo = self._new_info(name.rstrip('/') + '/')
+		zinfo.compress_type = zipfile.ZIP_STORED
+		zinfo.external_attr = (0o40755 << 16) | 0x10
+		self.archive.writestr(zinfo, b'')
+
+	def copy_member(self, archive, info):
+		if not isinstance(archive, ZipFile) or not self.raw:
+			return AbstractArchiveWriter.copy_member(self, archive, info)
+		self._write_pending()
+		source = archive.archive
+		with source._lock:
+			# The data follows the local header, whose extra field may differ
+			# from the one in the central directory
+			source.fp.seek(info.header_offset)
+			header = source.fp.read(zipfile.sizeFileHeader)
+			name_length, extra_length = struct.unpack('<HH', header[26:30])
+			source.fp.seek(info.header_offset + zipfile.sizeFileHeader +
+						name_length + extra_length)
+			self._write_raw(copy(info), _read_chunks(source.fp,
+												info.compress_size))
+
+	def _write_pending(self, keep=0):
+		"""Writes compressed members in order until at most keep are left"""
+		while len(self.pending) > keep:
+			zinfo, future = self.pending.popleft()
+			data, zinfo.CRC, zinfo.file_size = future.result()
+			zinfo.compress_size = len(data)
+			self._write_raw(zinfo, [data])
+
+	def _write_raw(self, zinfo, chunks):
+		"""Writes a member whose CRC, sizes and compress_type are set on zinfo
+		from already compressed chunks. zipfile has no public API for this, so
+		we do what ZipFile._open_to_write() does. Only used if
+		_raw_writes_supported()."""
+		archive = self.archive
+		# Sizes are known, so no data descriptor is needed after the data
+		zinfo.flag_bits &= ~0x08
+		zinfo.extra = zipfile._strip_extra(zinfo.extra, (1,))
+		zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+			zinfo.compress_size > zipfile.ZIP64_LIMIT
+		with archive._lock:
+			if archive._seekable:
+				archive.fp.seek(archive.start_dir)
+			zinfo.header_offset = archive.fp.tell()
+			archive._writecheck(zinfo)
+			archive._didModify = True
+			archive.fp.write(zinfo.FileHeader(zip64))
+			for chunk in chunks:
+				archive.fp.write(chunk)
+			archive.filelist.append(zinfo)
+			archive.NameToInfo[zinfo.filename] = zinfo
+			archive.start_dir = archive.fp.tell()
+
+	def close(self):
+		self._write_pending()
+		if self.pool is not None:
+			self.pool.shutdown()
+		self.archive.close()
+
+def _read_chunks(f, size):
+	while size > 0:
+		chunk = f.read(min(size, COPY_BUF_SIZE))
+		if not chunk:
+			raise EOFError('Unexpected end of archive data')
+		size -= len(chunk)
+		yield chunk
+
+class TarWriter(AbstractArchiveWriter):
+	"""Creates plain, gzip, bzip2 or xz compressed tar archives. tar has no
+	per-member compression, so members copied from a TarFile are streamed over
+	as they are."""
+	def __init__(self, filepath, fileobj=None, level=None, workers=1,
+				archive_type=ArchiveType.TAR):
+		AbstractArchiveWriter.__init__(self, filepath, fileobj, level, workers)
+		assert archive_type in _tar_modes
+		kwds = {}
+		if level is not None and archive_type == ArchiveType.XZ:
+			kwds['preset'] = level
+		elif level is not None and archive_type != ArchiveType.TAR:
+			kwds['compresslevel'] = level
+		mode = 'w:' + _tar_modes[archive_type]
+		self.compressor = None
+		if workers > 1 and archive_type in _parallel_compressors:
+			# We compress ourselves, tarfile writes a plain tar to us
+			self.compressor = ParallelCompressWriter(fileobj or filepath,
+									archive_type, level, workers)
+			fileobj, mode, kwds = self.compressor, 'w:', {}
+		if fileobj:
+			self.archive = tarfile.open(fileobj=fileobj, mode=mode, **kwds)
+		else:
+			self.archive = tarfile.open(name=filepath, mode=mode, **kwds)
+
+	def add_stream(self, name, stream, size=None):
+		spool = None
+		if size is None:
+			# The size goes in the header before the data, so find out first
+			spool = TemporaryFile()
+			copyfileobj(stream, spool, COPY_BUF_SIZE)
+			size = spool.tell()
+			spool.seek(0)
+			stream = spool
+		info = tarfile.TarInfo(name)
+		info.size = size
+		info.mtime = time.time()
+		info.mode = 0o644
+		self.archive.addfile(info, stream)
+		if spool is not None:
+			spool.close()
+
+	def add_dir(self, name):
+		info = tarfile.TarInfo(name.rstrip('/'))
+		info.type = tarfile.DIRTYPE
+		info.mtime = time.time()
+		info.mode = 0o755
+		self.archive.addfile(info)
+
+	def copy_member(self, archive, info):
+		if not isinstance(archive, TarFile):
+			return AbstractArchiveWriter.copy_member(self, archive, info)
+		stream = archive.archive.extractfile(info) if info.isreg() else None
+		self.archive.addfile(copy(info), stream)
+
+	def close(self):
+		self.archive.close()
+		if self.compressor is not None:
+			self.compressor.close()
+
+def _gzip_member(block, level):
+	"""Compresses block into a complete gzip member carrying its own size in
+	the 'PZ' header subfield."""
+	if level is None:
+		level = zlib.Z_DEFAULT_COMPRESSION
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	deflated = compressor.compress(block) + compressor.flush()
+	size = _parallel_gzip_header.size + len(deflated) + 8
+	# magic, method deflate, FEXTRA; mtime; xfl; os unknown; xlen; subfield
+	header = _parallel_gzip_header.pack(b'\x1f\x8b\x08\x04', 0, 0, 255, 8,
+									b'PZ', 4, size)
+	trailer = struct.pack('<II', zlib.crc32(block), len(block) & 0xffffffff)
+	return header + deflated + trailer
+
+def _xz_stream(block, level):
+	return lzma.compress(block, preset=level)
+
+# Compressions whose streams can be concatenated, with the function
+# compressing a block into a complete stream
+_parallel_compressors = {
+	ArchiveType.GZIP: _gzip_member,
+	ArchiveType.XZ: _xz_stream,
+	}
+
+class ParallelCompressWriter(RawIOBase):
+	"""Write-only file-like object compressing in the style of pigz. Data is
+	cut into blocks that are compressed independently on a thread pool (zlib
+	and lzma release the GIL) and written in order. The result is a valid
+	multi-member gzip or multi-stream xz file. Our gzip members also record
+	their size, which lets ParallelGzipReader inflate them in parallel."""
+	def __init__(self, target, archive_type=ArchiveType.GZIP, level=None,
+				workers=None, block_size=PARALLEL_BLOCK_SIZE):
+		self.own_file = isinstance(target, str)
+		self.fileobj = open(target, 'wb') if self.own_file else target
+		self.compress = _parallel_compressors[archive_type]
+		self.level = level
+		self.workers = workers or os.cpu_count() or 1
+		self.block_size = block_size
+		self.pool = ThreadPoolExecutor(self.workers)
+		self.pending = deque()
+		self.buffer = bytearray()
+		self.written = False
+		self.position = 0
+
+	def writable(self):
+		return True
+
+	def tell(self):
+		"""Gives the number of uncompressed bytes written"""
+		return self.position
+
+	def write(self, data):
+		self.position += len(data)
+		self.buffer += data
+		while len(self.buffer) >= self.block_size:
+			self._submit(bytes(self.buffer[:self.block_size]))
+			del self.buffer[:self.block_size]
+		return len(data)
+
+	def _submit(self, block):
+		self.pending.append(self.pool.submit(self.compress, block, self.level))
+		self.written = True
+		self._write_pending(self.workers * 2)
+
+	def _write_pending(self, keep=0):
+		while len(self.pending) > keep:
+			self.fileobj.write(self.pending.popleft().result())
+
+	def close(self):
+		if self.closed:
+			return
+		if self.buffer or not self.written:
+			# An empty input still needs one stream to be a valid file
+			self._submit(bytes(self.buffer))
+			self.buffer = bytearray()
+		self._write_pending()
+		self.pool.shutdown()
+		if self.own_file:
+			self.fileobj.close()
+		RawIOBase.close(self)
+
+def _parallel_member_size(header):
+	"""Gives the member size recorded in the extra field of a gzip header,
+	by _gzip_member() in a 'PZ' subfield or by bgzip in a 'BC' one. Returns
+	None if the header does not carry one."""
+	if len(header) < 12 or header[:3] != b'\x1f\x8b\x08' or \
+		not header[3] & 0x04:
+		return None
+	xlen = struct.unpack('<H', header[10:12])[0]
+	extra = header[12:12 + xlen]
+	while len(extra) >= 4:
+		subfield, length = extra[:2], struct.unpack('<H', extra[2:4])[0]
+		data = extra[4:4 + length]
+		if subfield == b'PZ' and len(data) == 4:
+			return struct.unpack('<I', data)[0]
+		if subfield == b'BC' and len(data) == 2:
+			# bgzip stores the size minus one
+			return struct.unpack('<H', data)[0] + 1
+		extra = extra[4 + length:]
+	return None
+
+def is_parallel_gzip(head):
+	"""Checks if a gzip file records the size of its members, as the ones
+	written by ParallelCompressWriter or bgzip do"""
+	return _parallel_member_size(head) is not None
+
+class ParallelGzipReader():
+	"""Seekable, read-only file-like object over a gzip file written by
+	ParallelCompressWriter or bgzip, given as a path or a fileobj. The member
+	sizes in the headers give the position of every member up front, so the
+	next members are read ahead and inflated on a thread pool, and seeking
+	only inflates the member seeked into."""
+	def __init__(self, source, workers=None):
+		self.own_file = isinstance(source, str)
+		self.fileobj = open(source, 'rb') if self.own_file else source
+		self.workers = workers or os.cpu_count() or 1
+		self.members = self._scan(self.fileobj)
+		self.starts = [ m[2] for m in self.members ]
+		self.length = self.members[-1][2] + self.members[-1][3] \
+			if self.members else 0
+		self.pool = ThreadPoolExecutor(self.workers)
+		self.ahead = deque()
+		self.block = b''
+		self.block_start = 0
+		self.next_member = 0
+		self.pos = 0
+
+	@staticmethod
+	def _scan(fileobj):
+		"""Lists the (offset, size, uncompressed offset, uncompressed size) of
+		every member by hopping from header to header."""
+		members = []
+		offset = uncompressed = 0
+		while True:
+			fileobj.seek(offset)
+			header = fileobj.read(12)
+			if not header:
+				return members
+			if len(header) == 12:
+				header += fileobj.read(struct.unpack('<H', header[10:12])[0])
+			size = _parallel_member_size(header)
+			if size is None:
+				raise Exception('Not a parallel gzip member at offset %d' % offset)
+			fileobj.seek(offset + size - 4)
+			isize = struct.unpack('<I', fileobj.read(4))[0]
+			members.append((offset, size, uncompressed, isize))
+			offset += size
+			uncompressed += isize
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self.pos
+
+	def seek(self, offset, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			offset += self.pos
+		elif whence == os.SEEK_END:
+			offset += self.length
+		self.pos = max(0, offset)
+		return self.pos
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			size = self.length - self.pos
+		chunks = []
+		while size > 0 and self.pos < self.length:
+			offset = self.pos - self.block_start
+			if not 0 <= offset < len(self.block):
+				self._load()
+				continue
+			chunk = self.block[offset:offset + size]
+			self.pos += len(chunk)
+			size -= len(chunk)
+			chunks.append(chunk)
+		return b''.join(chunks)
+
+	def _load(self):
+		"""Makes the member holding pos the current block"""
+		index = bisect_right(self.starts, self.pos) - 1
+		if not self.ahead or self.ahead[0][0] != index:
+			# Not a sequential read, drop whatever we read ahead
+			self.ahead.clear()
+			self.next_member = index
+		self._read_ahead()
+		index, future = self.ahead.popleft()
+		self.block = future.result()
+		self.block_start = self.starts[index]
+		self._read_ahead()
+
+	def _read_ahead(self):
+		while len(self.ahead) < self.workers and \
+			self.next_member < len(self.members):
+			offset, size = self.members[self.next_member][:2]
+			self.fileobj.seek(offset)
+			data = self.fileobj.read(size)
+			future = self.pool.submit(zlib.decompress, data, GZIP_WBITS)
+			self.ahead.append((self.next_member, future))
+			self.next_member += 1
+
+	def close(self):
+		self.pool.shutdown()
+		if self.own_file:
+			self.fileobj.close()
+
 def make_archive_obj(filepath, fileobj=None, inmemory_processing=True, allow_unsafe_extraction=False):
 	"""This method allows for smart opening of an archive file. Currently this
-	method can handle tar and zip archives. For the tar files, if the python
-	library has issues, the file is attempted to be processed by using the
-	tar command. (Note: the native classes are implemented to work only on
-	posix machines)"""
+	method can handle zip archives and plain, gzip, bzip2, xz or zstd compressed
+	tar archives. The type is sniffed from the first bytes of the file and the
+	matching class is used directly. zstd is not supported by the tarfile
+	module, those archives are processed using the tar command. (Note: the
+	native classes are implemented to work only on posix machines)
+
+	An http(s) url can be given as filepath, the archive is then read with
+	HTTP Range requests through pyrus.web.HTTPRangeFile, so listing it and
+	extracting some members only transfers the bytes they need."""
+	if not fileobj and filepath.startswith(('http://', 'https://')):
+		from pyrus.web.rangefile import HTTPRangeFile
+		fileobj = HTTPRangeFile(filepath)
 	if not fileobj:
 		assert os.path.isfile(filepath)
-		test_arg = filepath
-	else:
-		test_arg = fileobj
-	obj = None
-	if zipfile.is_zipfile(test_arg):
+	archive_type = _sniff_source(fileobj or filepath, filepath)
+	if archive_type == ArchiveType.ZIP:
 		obj = ZipFile(filepath, fileobj, inmemory_processing,
 					allow_unsafe_extraction)
-	elif is_tarfile(test_arg):
-		try:
-			obj = TarFile(filepath, fileobj, inmemory_processing,
-					allow_unsafe_extraction)
-		except:
-			obj = NativeTarFile(filepath, fileobj, inmemory_processing,
-								allow_unsafe_extraction)
+	elif archive_type in _tar_modes:
+		obj = TarFile(filepath, fileobj, inmemory_processing,
+					allow_unsafe_extraction, archive_type=archive_type)
+	elif archive_type == ArchiveType.ZSTD:
+		obj = NativeTarFile(filepath, fileobj, inmemory_processing,
+					allow_unsafe_extraction, archive_type)
 	else:
 		raise Exception("Unknown Archive Type: " +
 					"You should really just give me something I can digest!")
 	return obj
 
-def is_tarfile(arg):
-	"""Helper function to test if a given filepath/file-like-object is of a
-	tar like file.
+def read_head(arg, size=SNIFF_SIZE):
+	"""Reads the first size bytes of a filepath, or the next size bytes of a
+	file-like-object whose position is then left as it was."""
+	if isinstance(arg, str):
+		with open(arg, 'rb') as f:
+			return f.read(size)
+	last_position = arg.tell()
+	try:
+		return arg.read(size)
+	finally:
+		arg.seek(last_position)
 
-	Limitation: We use name extension to determine this if the arg is a
-	file-like-object. Valid extions are 'tar', 'gz', 'bz', 'bz2'."""
+def _is_tar_header(block):
+	"""Checks if block starts with a ustar, or an old v7 tar, header."""
+	if block[257:262] == b'ustar':
+		return True
+	if len(block) < tarfile.BLOCKSIZE or not block[0]:
+		return False
+	try:
+		checksum = int(block[148:156].strip(b'\x00 '), 8)
+	except ValueError:
+		return False
+	# The checksum is computed with its own field filled with spaces
+	return checksum == sum(block[:148]) + 8 * 32 + sum(block[156:512])
+
+def _decompress_head(archive_type, head):
+	"""Decompresses what we can of a compressed head. Returns None if the
+	compression does not produce output for a partial stream."""
+	try:
+		if archive_type == ArchiveType.GZIP:
+			return zlib.decompressobj(GZIP_WBITS).decompress(head)
+		if archive_type == ArchiveType.XZ:
+			return lzma.LZMADecompressor().decompress(head)
+	except (zlib.error, lzma.LZMAError):
+		return b''
+	return None
+
+def sniff_archive_type(head, name=None):
+	"""Gives the ArchiveType of a file from its first bytes (see read_head()),
+	or None if it is not an archive we can handle.
+
+	Compressed files are only reported if they hold a tar archive. bzip2 and
+	zstd only produce output for complete blocks, so for those we trust the
+	name if one is given and assume a tar archive otherwise."""
+	if head.startswith(_zip_magics):
+		return ArchiveType.ZIP
+	if _is_tar_header(head):
+		return ArchiveType.TAR
+	for magic, archive_type in _compression_magics:
+		if head.startswith(magic):
+			inner = _decompress_head(archive_type, head)
+			if inner is not None:
+				return archive_type if _is_tar_header(inner) else None
+			if name is None or name.lower().endswith(TAR_SUFFIXES):
+				return archive_type
+			return None
+	return None
+
+def _sniff_source(arg, name=None):
+	"""Sniffs the type of a filepath or file-like-object. Zips with something
+	prepended, such as self-extracting executables, do not start with a zip
+	magic and are found by their end of central directory record instead."""
+	archive_type = sniff_archive_type(read_head(arg), name)
+	if archive_type is not None:
+		return archive_type
 	if isinstance(arg, str):
-		# Process filepaths
-		tarfile.is_tarfile(arg)
-	elif hasattr(arg, 'name'):
-		# At the moment, we cannot check bytestreams for being tar files
-		return os.path.splitext(arg.name)[-1] in ['tar', 'gz', 'bz', 'bz2']
-	return False
+		return ArchiveType.ZIP if zipfile.is_zipfile(arg) else None
+	if not is_seekable(arg):
+		return None
+	last_position = arg.tell()
+	try:
+		return ArchiveType.ZIP if zipfile.is_zipfile(arg) else None
+	finally:
+		arg.seek(last_position)
+
+def _sniff(arg):
+	name = arg if isinstance(arg, str) else getattr(arg, 'name', None)
+	try:
+		return _sniff_source(arg, name if isinstance(name, str) else None)
+	except IOError:
+		return None
+
+def is_tarfile(arg):
+	"""Helper function to test if a given filepath/file-like-object is of a
+	tar like file, plain or compressed."""
+	return _sniff(arg) not in (None, ArchiveType.ZIP)
 
 def is_archive(arg):
 	"""Helper function to test if a given filepath/file-like-object is of a
 	an archive type we can handle."""
-	last_position = arg.tell() if hasattr(arg, 'tell') else 0
-	result = zipfile.is_zipfile(arg) or is_tarfile(arg)
-	if not isinstance(arg, str):
-		# Safety first since we handle file objects
-		arg.seek(last_position)
-	return result
+	return _sniff(arg) is not None
+
+# Records yielded by walk_archive(). The path is a tuple of the member names
+# leading to this member, starting in the outermost archive. The digest is
+# None unless an algorithm was requested.
+ArchiveRecord = namedtuple('ArchiveRecord', ['path', 'info', 'stream', 'digest'])
+
+WALK_MEMORY_LIMIT = 64 * 1024 * 1024
+
+def walk_archive(filepath, max_depth=None, fileobj=None, algorithm=None,
+				memory_limit=WALK_MEMORY_LIMIT, **filters):
+	"""Walks an archive and every archive nested in it (jar-in-war-in-tar)
+	in a single streaming pass, yielding an ArchiveRecord for every leaf
+	member. Nested tar archives are read straight from the enclosing stream,
+	nested zip archives need random access and are spooled to memory while
+	below memory_limit, or to a temporary file otherwise. The same applies to
+	leaves that are fingerprinted.
 
+	Streams are only valid until the next record is requested.
+
+	Keyword arguments:
+	filepath -- path (or name if fileobj is given) of the outermost archive
+	max_depth -- how many archive levels to open (default None, unlimited)
+	fileobj -- file-like object holding the outermost archive (default None)
+	algorithm -- pyrus.checksum algorithm to fingerprint leaves with
+	memory_limit -- bytes that may be held in memory at once
+	filters -- pattern, min_size, max_size and types as in iter_members(),
+	these only apply to the leaves yielded.
+	"""
+	budget = _MemoryBudget(memory_limit)
+	archive = make_archive_obj(filepath, fileobj)
+	entries = ( (type(archive), info, stream)
+			for info, stream in archive.iter_members() )
+	return _walk(entries, (), 1, max_depth, algorithm, budget, filters)
+
+class _MemoryBudget():
+	"""Keeps count of the bytes walk_archive() currently holds in memory."""
+	def __init__(self, limit):
+		self.limit = limit
+		self.used = 0
+
+	def reserve(self, size):
+		if self.used + size > self.limit:
+			return False
+		self.used += size
+		return True
+
+	def release(self, size):
+		self.used -= size
+
+class _HeadedStream():
+	"""A read-only stream replaying an already consumed head before reading
+	the rest of the underlying stream."""
+	def __init__(self, head, stream):
+		self.head = head
+		self.stream = stream
+
+	def read(self, size=-1):
+		if not self.head:
+			return self.stream.read(size)
+		if size is None or size < 0:
+			data, self.head = self.head + self.stream.read(), b''
+			return data
+		data, self.head = self.head[:size], self.head[size:]
+		if len(data) < size:
+			data += self.stream.read(size - len(data))
+		return data
+
+class _RecordingStream():
+	"""A read-only stream keeping a copy of what is read from the underlying
+	stream, till stop() is called."""
+	def __init__(self, stream):
+		self.stream = stream
+		self.recorded = BytesIO()
+
+	def read(self, size=-1):
+		data = self.stream.read(size)
+		if self.recorded is not None:
+			self.recorded.write(data)
+		return data
+
+	def stop(self):
+		self.recorded = None
+
+def _spool(stream, size, budget, digest=None):
+	"""Copies a stream into memory if size fits in the budget, else into a
+	temporary file. Returns the rewound copy and the bytes reserved."""
+	if budget.reserve(size):
+		spool, reserved = BytesIO(), size
+	else:
+		spool, reserved = TemporaryFile(), 0
+	for buf in iter(lambda: stream.read(COPY_BUF_SIZE), b''):
+		if digest is not None:
+			digest.update(buf)
+		spool.write(buf)
+	spool.seek(0)
+	return spool, reserved
+
+def _iter_tar_stream(archive):
+	for info in archive:
+		yield TarFile, info, archive.extractfile(info) if info.isreg() else None
+
+def _walk(entries, path, depth, max_depth, algorithm, budget, filters):
+	for cls, info, stream in entries:
+		name = cls.filename_from_info(info)
+		member_path = path + (name,)
+		reserved = 0
+		if stream is not None and (max_depth is None or depth < max_depth):
+			head = stream.read(SNIFF_SIZE)
+			stream = _HeadedStream(head, stream)
+			archive_type = sniff_archive_type(head, name)
+			if archive_type in _tar_modes:
+				mode = 'r|' + _tar_modes[archive_type]
+				# What is read while opening is kept, so that a member that
+				# is not a tar after all can still be yielded whole
+				recorder = _RecordingStream(stream)
+				try:
+					nested = tarfile.open(fileobj=recorder, mode=mode)
+				except (tarfile.ReadError, tarfile.CompressionError):
+					# Not a tar after all, treat it as a leaf
+					stream = _HeadedStream(recorder.recorded.getvalue(), stream)
+					nested = None
+				if nested is not None:
+					recorder.stop()
+					with nested:
+						yield from _walk(_iter_tar_stream(nested), member_path,
+							depth + 1, max_depth, algorithm, budget, filters)
+					continue
+			if archive_type == ArchiveType.ZIP:
+				stream, reserved = _spool(stream, cls.size_from_info(info),
+										budget)
+				try:
+					nested = ZipFile(name, stream, allow_unsafe_extraction=True)
+				except zipfile.BadZipFile:
+					# Not a zip after all, treat it as a leaf
+					nested = None
+				if nested is not None:
+					entries = ( (ZipFile, i, s) for i, s in nested.iter_members() )
+					try:
+						yield from _walk(entries, member_path, depth + 1,
+									max_depth, algorithm, budget, filters)
+					finally:
+						budget.release(reserved)
+						stream.close()
+					continue
+		try:
+			if not cls.member_matches(info, **filters):
+				continue
+			digest = None
+			if algorithm is not None and stream is not None:
+				digest = algorithms[algorithm.lower()]()
+				stream, leaf_reserved = _spool(stream, cls.size_from_info(info),
+											budget, digest)
+				reserved += leaf_reserved
+				digest = digest.hexdigest()
+			yield ArchiveRecord(member_path, info, stream, digest)
+		finally:
+			budget.release(reserved)
@@ -1,16 +1,27 @@
 import atexit
+import os
+import struct
+import sys
 import time
+import multiprocessing
+from io import BytesIO
+from random import random
+from ctypes import c_char, c_uint8, c_uint32
 from logging import NOTSET, INFO, DEBUG, WARN, ERROR, CRITICAL
 from logging import addLevelName, getLevelName
-from multiprocessing import Process, current_process
+from multiprocessing import current_process
 from multiprocessing.managers import BaseManager, BaseProxy
-from pyrus import AbstractQueueConsumer
+from multiprocessing.sharedctypes import RawArray, RawValue
+from multiprocessing.util import ForkAwareThreadLock
+from threading import Lock
+from weakref import WeakSet
+from pyrus import AbstractQueueConsumer, Backend, Overflow
 
 DFAULT_LOG_LEVEL = INFO
 
 class LogMessage():
-	def __init__(self, name, level, msg, pid=None):
-		self.logtime = time.localtime()
+	def __init__(self, name, level, msg, pid=None, created=None):
+		self.logtime = time.localtime(created)
 		self.level = level
 		self.msg = msg
 		self.name = name
@@ -24,6 +35,149 @@ class LogMessage():
 		return '[%s] [%s] [%s] [%s] %s' % (time.asctime(self.logtime), level,
 						self.name, self.pid, self.msg)
 
+# Log records travel through the queue, and are stored by a log sink, as
+# binary chunks. A name chunk binds a logger name to an id, a record chunk
+# refers to its logger by that id.
+CHUNK_NAME = 1
+CHUNK_RECORD = 2
+_name_chunk = struct.Struct('<BHH')       # kind, name id, name length
+_record_chunk = struct.Struct('<BdIhHI')  # kind, time, pid, level, name id,
+                                          # message length
+# Names that could not be interned are sent in a name chunk with this id
+# right before their record
+INLINE_NAME_ID = 0xFFFF
+LOG_FILE_MAGIC = b'PYRUSLOG\x01\x00'
+
+NAME_TABLE_SIZE = 1024
+NAME_WIDTH = 128
+
+class LogFormatException(Exception): pass
+
+def encode_name(nid, name):
+	data = name.encode()
+	return _name_chunk.pack(CHUNK_NAME, nid, len(data)) + data
+
+def encode_record(created, pid, level, nid, msg):
+	"""Returns the record chunk of msg, any object formatted with %s"""
+	data = str(msg).encode()
+	return _record_chunk.pack(CHUNK_RECORD, created, pid, level, nid,
+							len(data)) + data
+
+def decode_stream(fileobj, names=None):
+	"""Yields the LogMessage of every record chunk read from fileobj.
+
+	Names are resolved from the name chunks of the stream, then with the
+	names callable, given a name id, if any."""
+	known = {}
+	while True:
+		kind = fileobj.read(1)
+		if not kind:
+			break
+		if kind == LOG_FILE_MAGIC[:1]:
+			if kind + fileobj.read(len(LOG_FILE_MAGIC) - 1) != LOG_FILE_MAGIC:
+				raise LogFormatException('Bad log file header')
+			continue
+		if kind[0] == CHUNK_NAME:
+			header = kind + fileobj.read(_name_chunk.size - 1)
+			_, nid, length = _name_chunk.unpack(header)
+			known[nid] = fileobj.read(length).decode()
+		elif kind[0] == CHUNK_RECORD:
+			header = kind + fileobj.read(_record_chunk.size - 1)
+			_, created, pid, level, nid, length = _record_chunk.unpack(header)
+			msg = fileobj.read(length).decode()
+			name = known.get(nid)
+			if name is None and names is not None:
+				name = names(nid)
+			yield LogMessage(name, level, msg, pid, created)
+		else:
+			raise LogFormatException('Unknown chunk kind %d' % kind[0])
+
+def decode_records(data, names=None):
+	"""Yields the LogMessage of every record chunk in data"""
+	return decode_stream(BytesIO(data), names)
+
+def read_log(path):
+	"""Yields the LogMessage of every record in a log sink file"""
+	with open(path, 'rb') as f:
+		for msg in decode_stream(f):
+			yield msg
+
+class _NameTable():
+	"""Logger names interned to small ids. The table is kept in shared memory,
+	so forked consumers can resolve names interned after they started."""
+	def __init__(self, size=NAME_TABLE_SIZE):
+		self.size = size
+		self._data = RawArray(c_char, size * NAME_WIDTH)
+		self._lengths = RawArray(c_uint8, size)
+		self._count = RawValue(c_uint32, 0)
+		self._lock = multiprocessing.Lock()
+		self._ids = {}
+
+	def intern(self, name):
+		"""Returns the id of name, None if the name is too long or the table
+		is full."""
+		nid = self._ids.get(name)
+		if nid is not None:
+			return nid
+		data = name.encode()
+		if len(data) >= NAME_WIDTH:
+			return None
+		with self._lock:
+			nid = self._ids.get(name)
+			if nid is None:
+				nid = self._count.value
+				if nid >= self.size:
+					return None
+				start = nid * NAME_WIDTH
+				self._data[start:start + len(data)] = data
+				self._lengths[nid] = len(data)
+				# Published once the name is in place
+				self._count.value = nid + 1
+				self._ids[name] = nid
+		return nid
+
+	def lookup(self, nid):
+		if nid >= self._count.value:
+			return None
+		start = nid * NAME_WIDTH
+		return self._data[start:start + self._lengths[nid]].decode()
+
+class _LogSink():
+	"""Appends binary records to a log file. The names a record refers to are
+	written before it the first time they are used, so the file can be read on
+	its own."""
+	def __init__(self, path):
+		self._lock = Lock()
+		self._defined = set()
+		try:
+			self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT
+							| os.O_EXCL, 0o644)
+			os.write(self._fd, LOG_FILE_MAGIC)
+		except FileExistsError:
+			self._fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+	def write(self, data, names):
+		with self._lock:
+			if data[0] == CHUNK_RECORD:
+				nid = _record_chunk.unpack_from(data)[4]
+				if nid not in self._defined:
+					data = encode_name(nid, names.lookup(nid)) + data
+					self._defined.add(nid)
+			# A single write per record keeps appends from several
+			# consumers whole
+			os.write(self._fd, data)
+
+# The sinks opened by the consumers of this process, by path
+_sinks = {}
+_sinks_lock = Lock()
+
+def _sink(path):
+	with _sinks_lock:
+		key = (os.getpid(), path)
+		if key not in _sinks:
+			_sinks[key] = _LogSink(path)
+		return _sinks[key]
+
 class _Logging(AbstractQueueConsumer):
 	"""_Logging class is a multiprocessing safe logging class. This class is
 	designed with the Borg DP in mind . (All instances of this class shares the
@@ -32,8 +186,14 @@ class _Logging(AbstractQueueConsumer):
 	By design, this acts like a server consuming messages from a MP Queue. The
 	loggers received from get_logger() methed can communicate using this Queue.
 	"""
-	def __init__(self, consumers=1):
-		AbstractQueueConsumer.__init__(self, consumers)
+	# Printing records is I/O bound, consumers need not be processes
+	backend = Backend.THREAD
+	# Under overload sample log lines rather than grow without bound
+	queue_size = 10000
+	overflow = Overflow.SAMPLE
+
+	def __init__(self, consumers=1, *args, sink=None):
+		AbstractQueueConsumer.__init__(self, consumers, *args, sink=sink)
 
 	@property
 	def level(self):
@@ -57,23 +217,46 @@ class _Logging(AbstractQueueConsumer):
 		logging.addLevelName."""
 		addLevelName(level, levelName)
 
-	def _initialize(self, consumers):
+	def _initialize(self, consumers, *args, sink=None):
 		"""Internal method to initialize all global variables. This initializes
-		the manager, queue, pool and trigger the consumer."""
+		the manager, queue, pool and trigger the consumer.
+
+		If a sink path is given, records are appended to it in binary instead
+		of being printed, see read_log()."""
 		self.level = DFAULT_LOG_LEVEL
+		self._names = _NameTable()
+		self._sink_path = sink
 		# This is used to securely terminate the logging process once started
-		AbstractQueueConsumer._initialize(self, consumers)
+		AbstractQueueConsumer._initialize(self, consumers, *args)
 
 	def __log_direct(self, name, level, message):
 		log = str(LogMessage(name, level, message))
 		print(log)
 
-	def _record_handler(self, record):
-		print(record)
+	def _record_handler(self, data):
+		if self._sink_path:
+			_sink(self._sink_path).write(data, self._names)
+		else:
+			for record in decode_records(data, self._names.lookup):
+				print(record)
+
+	def intern(self, name):
+		"""Returns the id of a logger name, None if it cannot be interned"""
+		return self._names.intern(name)
+
+	def record(self, data):
+		"""Queues the chunks of a record, as encoded by its producer"""
+		self._put(data)
 
 	def log(self, name, level, msg, pid):
-		log = str(LogMessage(name, level, msg, pid))
-		self._put(log)
+		self._put(_encode(time.time(), pid, level, self.intern(name), name, msg))
+
+def _encode(created, pid, level, nid, name, msg):
+	"""Returns the chunks of a record, led by its name if it has no id"""
+	if nid is None:
+		return encode_name(INLINE_NAME_ID, name) + encode_record(created, pid,
+												level, INLINE_NAME_ID, msg)
+	return encode_record(created, pid, level, nid, msg)
 
 class _Logger():
 	"""A poor man's implementation of a _Logger class for the use in
@@ -85,9 +268,16 @@ class _Logger():
 
 	def _log(self, pid, level, msg):
 		if level >= self.level:
-			args = (self.name, level, msg, pid)
-			p = Process(target=self.server.log, args=args)
-			p.start()
+			self.server.log(self.name, level, msg, pid)
+
+	def name_id(self):
+		"""Returns the id of the logger name, and the name itself"""
+		return self.server.intern(self.name), self.name
+
+	def record(self, level, data):
+		"""Queues a record encoded by the producer, if its level is enabled"""
+		if level >= self.level:
+			self.server.record(data)
 
 	def get_log_level(self):
 		return self.level
@@ -116,22 +306,243 @@ class _Logger():
 	def log(self, pid, level, msg):
 		self._log(pid, level, msg)
 
-class _LoggerProxy(BaseProxy):
+REPEAT_MESSAGE = 'Last message repeated %d times'
+
+class _Throttle():
+	"""Decides, in the producing process, which log calls are sent to the
+	logging manager at all. Three controls can be enabled:
+
+	- a token bucket allowing rate calls per second, with bursts of burst;
+	- sampling, keeping the given fraction of the calls;
+	- collapsing repeats of the last message into a single REPEAT_MESSAGE
+	  sent with the next different message, or by flush().
+
+	Each control is tracked per call site, or for the whole logger if
+	per_site is False. Only the settings are pickled, the counters and
+	pending repeats stay in their process."""
+	def __init__(self):
+		self.rate = None
+		self.burst = 1
+		self.rate_per_site = True
+		self.sampling = None
+		self.sampling_per_site = True
+		self.collapse = False
+		self.collapse_per_site = True
+		self._reset()
+
+	def _reset(self):
+		self.suppressed = 0
+		self._buckets = {}
+		self._credits = {}
+		self._last = {}
+		self._lock = ForkAwareThreadLock()
+
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		for attr in ('suppressed', '_buckets', '_credits', '_last', '_lock'):
+			del state[attr]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._reset()
+
+	@property
+	def enabled(self):
+		return self.rate is not None or self.sampling is not None \
+			or self.collapse
+
+	def set_rate_limit(self, rate, burst=1, per_site=True):
+		"""Limits calls to rate per second, None removes the limit"""
+		with self._lock:
+			self.rate = rate
+			self.burst = burst
+			self.rate_per_site = per_site
+			self._buckets = {}
+
+	def set_sampling(self, probability, per_site=True):
+		"""Keeps the given fraction of the calls, None keeps them all"""
+		with self._lock:
+			self.sampling = probability
+			self.sampling_per_site = per_site
+			self._credits = {}
+
+	def set_collapse_repeats(self, enabled=True, per_site=True):
+		with self._lock:
+			self.collapse = enabled
+			self.collapse_per_site = per_site
+			self._last = {}
+
+	def admit(self, level, msg, depth):
+		"""Returns the (level, msg) pairs to send for a call, none if the call
+		is suppressed. depth is the number of frames between this method and
+		the caller of the logger."""
+		if not self.enabled:
+			return [(level, msg)]
+		site = None
+		if (self.rate is not None and self.rate_per_site) \
+		or (self.sampling is not None and self.sampling_per_site) \
+		or (self.collapse and self.collapse_per_site):
+			frame = sys._getframe(depth + 1)
+			site = (frame.f_code.co_filename, frame.f_lineno)
+		with self._lock:
+			sends = []
+			if self.collapse:
+				key = site if self.collapse_per_site else None
+				last = self._last.get(key)
+				if last is not None and last[0] == level and last[1] == msg:
+					last[2] += 1
+					self.suppressed += 1
+					return sends
+				if last is not None and last[2]:
+					sends.append((last[0], REPEAT_MESSAGE % last[2]))
+				self._last[key] = [level, msg, 0]
+			if self.sampling is not None:
+				# Each site keeps its share of calls, from a random start so
+				# that sites seen once are still kept with the probability
+				key = site if self.sampling_per_site else None
+				credit = self._credits.get(key)
+				if credit is None:
+					credit = random()
+				credit += self.sampling
+				if credit < 1:
+					self._credits[key] = credit
+					self.suppressed += 1
+					return sends
+				self._credits[key] = credit - 1
+			if self.rate is not None:
+				key = site if self.rate_per_site else None
+				now = time.monotonic()
+				tokens, then = self._buckets.get(key, (self.burst, now))
+				tokens = min(self.burst, tokens + (now - then) * self.rate)
+				if tokens < 1:
+					self._buckets[key] = (tokens, now)
+					self.suppressed += 1
+					return sends
+				self._buckets[key] = (tokens - 1, now)
+			sends.append((level, msg))
+			return sends
+
+	def flush(self):
+		"""Returns the (level, msg) pairs of the repeat counts collapsed since
+		their last message, and forgets them"""
+		with self._lock:
+			sends = []
+			for last in self._last.values():
+				if last[2]:
+					sends.append((last[0], REPEAT_MESSAGE % last[2]))
+					last[2] = 0
+			return sends
+
+	def forget(self):
+		"""Drops the repeats collapsed so far, without sending them"""
+		with self._lock:
+			self._last = {}
+
+class _ThrottledLogger():
+	"""The throttle controls of a logger, see _Throttle"""
+	def set_rate_limit(self, rate, burst=1, per_site=True):
+		self._throttle.set_rate_limit(rate, burst, per_site)
+
+	def set_sampling(self, probability, per_site=True):
+		self._throttle.set_sampling(probability, per_site)
+
+	def set_collapse_repeats(self, enabled=True, per_site=True):
+		self._throttle.set_collapse_repeats(enabled, per_site)
+
+	def suppressed_count(self):
+		"""Returns the number of calls the throttle did not send"""
+		return self._throttle.suppressed
+
+class _LoggerMethods(_ThrottledLogger):
+	"""The logging methods of a logger. Calls suppressed by the throttle
+	never leave this process, the others are handed to _emit()."""
+	# Generate methods that require current pid
+	for meth, level in [('critical', CRITICAL), ('error', ERROR),
+			('info', INFO), ('warning', WARN), ('warn', WARN), ('debug', DEBUG)]:
+		exec('''def %s(self, msg):
+		self._send(%d, msg)''' % (meth, level))
+	del meth, level
+
+	def log(self, level, msg):
+		self._send(level, msg)
+
+	def _send(self, level, msg):
+		pid = current_process().pid
+		if self._throttle.collapse:
+			_collapsing.add(self)
+		for level, msg in self._throttle.admit(level, msg, 2):
+			self._emit(pid, level, msg)
+
+	def flush(self):
+		"""Sends the repeat counts collapsed since their last message"""
+		pid = current_process().pid
+		for level, msg in self._throttle.flush():
+			self._emit(pid, level, msg)
+
+# Loggers which may hold collapsed repeats, flushed at exit
+_collapsing = WeakSet()
+
+def _forget_repeats():
+	# Repeats collapsed before a fork are sent by the parent only
+	for logger in list(_collapsing):
+		logger._throttle.forget()
+	_collapsing.clear()
+
+os.register_at_fork(after_in_child=_forget_repeats)
+
+def _rebuild_logger(rebuild, args, throttle):
+	logger = rebuild(*args)
+	logger._throttle = throttle
+	return logger
+
+class _LoggerProxy(BaseProxy, _LoggerMethods):
 	def __init__(self, token, serializer, manager=None,
 		authkey=None, exposed=None, incref=True):
 		BaseProxy.__init__(self, token, serializer, manager=manager, authkey=authkey, exposed=exposed, incref=incref)
 		self.pid = current_process().pid
+		self._throttle = _Throttle()
+		self._name_id = None
 
 	# Generate normal proxy methods
 	for meth in ['get_log_level', 'set_log_level']:
 		exec('''def %s(self, *args, **kwds):
 		return self._callmethod(%r, args, kwds)''' % (meth, meth))
 
-	# Generate proxy methods that require current pid
-	for meth in ['critical', 'log', 'info', 'warning', 'warn', 'debug']:
-		exec('''def %s(self, *args, **kwds):
-		pid = current_process().pid
-		return self._callmethod(%r, (pid,) + args, kwds)''' % (meth, meth))
+	def __reduce__(self):
+		# Keeps the throttle settings along with the proxy
+		rebuild, args = BaseProxy.__reduce__(self)
+		return _rebuild_logger, (rebuild, args, self._throttle)
+
+	def _emit(self, pid, level, msg):
+		# Records are encoded here, so only their compact chunks are sent to
+		# the logging manager
+		if self._name_id is None:
+			self._name_id = self._callmethod('name_id')
+		nid, name = self._name_id
+		self._callmethod('record', (level,
+							_encode(time.time(), pid, level, nid, name, msg)))
+
+class _LocalLogger(_LoggerMethods):
+	"""A logger printing its records itself, used in daemonic processes that
+	find no logging manager to send them to and cannot start one."""
+	def __init__(self, name, level):
+		self.name = name
+		self.level = level
+		self._throttle = _Throttle()
+
+	def get_log_level(self):
+		return self.level
+
+	def set_log_level(self, level):
+		self.level = level
+
+	def _emit(self, pid, level, msg):
+		if level >= self.level:
+			# A single write keeps lines of other processes out of ours, and
+			# pool workers are terminated without flushing stdout
+			sys.stdout.write('%s\n' % LogMessage(self.name, level, msg, pid))
+			sys.stdout.flush()
 
 # A simple manager so we are multiprocessing safe
 class LoggingManager(BaseManager): pass
@@ -140,33 +551,149 @@ class LoggingManager(BaseManager): pass
 LoggingManager.register('Logging', _Logging)
 LoggingManager.register('Logger', _Logger, _LoggerProxy)
 
-# Start the module logging manager
-__logging_manager = LoggingManager()
-__logging_manager.start()
-
-# The global instance of _Logging to kickstart log consumer on import
-__mplogging = __logging_manager.Logging()
+# Processes started by multiprocessing, with any start method, find the
+# logging manager of their ancestors at the address in this variable
+LOGGING_ADDRESS_ENV = 'PYRUS_LOGGING_ADDRESS'
+
+# The module logging manager and the global instance of _Logging. These are
+# started on first use, so that importing modules which create loggers stays
+# cheap.
+__logging_manager = None
+__mplogging = None
+__owner_pid = None
+__start_lock = Lock()
+# The global level of daemonic processes logging on their own
+__local_level = DFAULT_LOG_LEVEL
+
+def _connect_ancestor():
+	"""Connects to the logging manager started by an ancestor process.
+	Returns the manager and its _Logging proxy, or None if there is none."""
+	address = os.environ.get(LOGGING_ADDRESS_ENV)
+	if address is None or multiprocessing.parent_process() is None:
+		return None
+	manager = LoggingManager(address)
+	try:
+		manager.connect()
+		return manager, manager.Logging()
+	except (OSError, multiprocessing.AuthenticationError):
+		return None
+
+def start(sink=None):
+	"""Starts the logging manager and the log consumer if they are not running
+	yet. Returns the global _Logging proxy.
+
+	Processes forked afterwards share them, and processes started by
+	multiprocessing in any other way connect to them, instead of starting
+	their own. Daemonic processes cannot start a logging manager: if there is
+	none to connect to, None is returned and their loggers print records
+	themselves.
+
+	If a sink path is given, records are appended to it in binary instead of
+	being printed. It is ignored if logging was already started."""
+	global __logging_manager, __mplogging, __owner_pid
+	with __start_lock:
+		if __mplogging is None:
+			connected = _connect_ancestor()
+			if connected is not None:
+				__logging_manager, __mplogging = connected
+			elif not current_process().daemon:
+				manager = LoggingManager()
+				manager.start()
+				__mplogging = manager.Logging(sink=sink)
+				__logging_manager = manager
+				__owner_pid = os.getpid()
+				if isinstance(manager.address, str):
+					os.environ[LOGGING_ADDRESS_ENV] = manager.address
+	return __mplogging
+
+def is_started():
+	return __mplogging is not None
+
+def _create_logger(name, level):
+	mplogging = start()
+	if mplogging is None:
+		return _LocalLogger(name, __local_level if level is None else level)
+	if level is None:
+		level = mplogging.get_log_level()
+	pid = current_process().pid
+	return __logging_manager.Logger(name, level, mplogging, pid)
+
+class _LazyLogger(_ThrottledLogger):
+	"""Stands in for the logger proxy of the logging manager until it is first
+	used. Loggers can then be created, and throttled, at import time without
+	starting the logging manager."""
+	def __init__(self, name, level):
+		self._name = name
+		self._level = level
+		self._logger = None
+		self._throttle = _Throttle()
+
+	def _resolve(self):
+		if self._logger is None:
+			logger = _create_logger(self._name, self._level)
+			logger._throttle = self._throttle
+			self._logger = logger
+		return self._logger
+
+	def __getstate__(self):
+		# The logger is created again where this is unpickled
+		state = dict(self.__dict__)
+		state['_logger'] = None
+		return state
+
+	def __getattr__(self, attr):
+		if attr.startswith('_'):
+			# Keeps copy/pickle probing from starting the manager
+			raise AttributeError(attr)
+		return getattr(self._resolve(), attr)
 
 def Logger(name=__name__, level=None):
 	"""Returns a _Logger instance for the given name. If no level is given
-	the global level is used. The class state caches the loggeres that are
-	created and reuses them as required."""
-	if level is None:
-		level = __mplogging.get_log_level()
-	pid = current_process().pid
-	return __logging_manager.Logger(name, level, __mplogging, pid)
+	the global level is used. The logger is only created in the logging
+	manager once it is first used."""
+	return _LazyLogger(name, level)
 
 def set_log_level(level):
 	"""Sets the global logging level"""
-	__mplogging.set_log_level(level)
+	global __local_level
+	mplogging = start()
+	if mplogging is None:
+		__local_level = level
+	else:
+		mplogging.set_log_level(level)
 
 def get_log_level():
 	"""Returns the global logging level"""
-	return __mplogging.get_log_level()
+	mplogging = start()
+	return __local_level if mplogging is None else mplogging.get_log_level()
 
 @atexit.register
 def __graceful_shutdown():
 	"""This method triggers the shutdown of the logging consumer. This is
-	triggerred only when the python interpreter exits."""
+	triggerred only when the python interpreter exits, and only if logging
+	was started by this process."""
+	if not is_started() or __owner_pid != os.getpid():
+		return
 	Logger(__name__).debug('Shutting down logging')
 	__mplogging.shutdown()
+
+@atexit.register
+def __flush_repeats():
+	"""Sends the repeats collapsed by the loggers of this process. This is
+	registered last so that it runs before the logging shutdown."""
+	for logger in list(_collapsing):
+		logger.flush()
+
+def main(argv=None):
+	"""Prints the records of binary log sink files as text"""
+	from argparse import ArgumentParser
+	parser = ArgumentParser(prog='python -m pyrus.mplogging',
+						description=main.__doc__)
+	parser.add_argument('files', nargs='+', metavar='FILE')
+	args = parser.parse_args(argv)
+	for path in args.files:
+		for record in read_log(path):
+			print(record)
+
+if __name__ == '__main__':
+	main()
@@ -1,9 +1,11 @@
 from http.cookiejar import CookieJar
-from urllib.request import build_opener, urlopen, HTTPCookieProcessor
+from urllib.request import build_opener, HTTPCookieProcessor
 from urllib.error import HTTPError
 from urllib.parse import urlencode
 from copy import deepcopy
 from pyrus.util import base64encode, base64decode
+from pyrus.web.probe import probe, probe_many, ProbeResult, PROBE_CONCURRENCY
+from pyrus.web.rangefile import HTTPRangeFile, RangeNotSupportedException
 
 class CookiedOpener:
 	def __init__(self, cj=CookieJar()):
@@ -51,14 +53,19 @@ def open_url(url, opener=build_opener(), data=None):
 	response = opener.open(url, data)
 	return response
 
-def test_url(url):
+def test_url(url, cache=None):
 	"""Checks if a url resource is available. Returns True if response status
-	is in (200, 301, 302)."""
-	try:
-		response = urlopen(url, timeout=1)
-		return response.status in (200, 301, 302)
-	except:
-		return False
+	is in (200, 206, 301, 302). Redirects are followed, and the body is not
+	downloaded, see probe(). Every call sends a request, unless a ProbeCache
+	is given."""
+	return probe(url, cache=cache).status in (200, 206, 301, 302)
+
+def test_urls(urls, concurrency=PROBE_CONCURRENCY, cache=None):
+	"""Checks, concurrently, which of the urls are available. Returns a dict of
+	the test_url() result of each url."""
+	results = probe_many(urls, concurrency, cache=cache)
+	return dict((url, result.status in (200, 206, 301, 302))
+				for url, result in results.items())
 
 def _response(arg):
 	if isinstance(arg, str):
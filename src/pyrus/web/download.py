@@ -1,16 +1,24 @@
 import atexit
+import pickle
 from io import BytesIO
 from time import sleep
 from os.path import exists
 from urllib.request import urlopen, Request
 from multiprocessing.managers import BaseManager
+from threading import Lock
+from pyrus import mplogging
 from pyrus.mplogging import Logger
-from pyrus import AbstractQueueConsumer
+from pyrus import AbstractQueueConsumer, Backend, enum
 
 logger = Logger('pyrus.download')
 
 DOWNLOAD_USER_AGENT = 'python'
 BUF_SIZE = 4096
+WAIT_POLL_INTERVAL = 0.05
+
+# Download states as stored by the pool
+Status = enum(DOWNLOADING=1, DONE=2, FAILED=3)
+_FINISHED = (Status.DONE, Status.FAILED)
 
 # Download states
 class DownloadState(object):
@@ -53,80 +61,101 @@ def download_string(url):
 	return bio.getvalue().decode()
 
 class DownloadPool(AbstractQueueConsumer):
-	def __init__(self, consumers=4):
-		AbstractQueueConsumer.__init__(self, consumers)
+	# Downloads wait on the network, consumers need not be processes
+	backend = Backend.THREAD
+	# Producers wait for room once this many downloads are queued
+	queue_size = 1000
+
+	def __init__(self, consumers=4, *args):
+		AbstractQueueConsumer.__init__(self, consumers, *args)
+
+	def _initialize(self, consumers, backend=None, *args):
+		# The status and payload of each download, by url. Consumer threads
+		# share the pool memory, so checking a status is a dict read, while
+		# consumer processes go through the manager.
+		if (backend or self.backend) == Backend.PROCESS:
+			self._downloads = self._manager.dict()
+			self._lock = self._manager.Lock()
+		else:
+			self._downloads = {}
+			self._lock = Lock()
+		AbstractQueueConsumer._initialize(self, consumers, backend, *args)
 
-	def _initialize(self, consumers):
-		self._downloads = self._manager.dict()
-		self._results = self._manager.dict()
-		AbstractQueueConsumer._initialize(self, consumers)
+	def _status(self, url):
+		"""Returns the status of url, or None if it is unknown, and the
+		payload of a finished download"""
+		return self._downloads.get(url, (None, None))
 
 	def get_state(self, url):
 		"""Returns the state of a given url.
 
-		If a given url is in the downloads dictionary, it's state is returned
+		If a given url is in the downloads table, it's state is returned
 		and if it cannot be found a None object is returned.
 
-		Expected states are DownloadStarted, DownloadDone and DownloadException.
+		Expected states are Downloading, Done and DownloadException.
 		"""
-		return self._downloads.get(url, None)
+		status, payload = self._status(url)
+		if status == Status.DOWNLOADING:
+			return Downloading(url)
+		if status == Status.DONE:
+			return Done(url, payload)
+		if status == Status.FAILED:
+			return DownloadException(url, payload)
+		return None
 
 	def discard_result(self, result):
 		assert isinstance(result, DownloadResult)
-		if result.url in self._downloads:
-			del self._downloads[result.url]
+		self._downloads.pop(result.url, None)
 
 	def wait(self, result):
-		while (result.url not in self._downloads):
-			sleep(0.5)
+		"""Waits till the download of result is done or failed"""
+		while self._status(result.url)[0] not in _FINISHED:
+			sleep(WAIT_POLL_INTERVAL)
 
 	def fetch_download(self, result, block=False, discard_done=True):
+		"""Returns the target of a done download, None if it failed or is not
+		done yet. Finished downloads are forgotten once fetched, unless
+		discard_done is False."""
 		assert isinstance(result, DownloadResult)
 		if block:
 			self.wait(result)
-		if result.url in self._downloads:
-			state = self._downloads[result.url]
-			if isinstance(state, Done):
-				value = state.memobj
-				if discard_done:
-					self.discard_result(result)
-				return value
-		return None
+		status, payload = self._status(result.url)
+		if status in _FINISHED and discard_done:
+			self.discard_result(result)
+		return payload if status == Status.DONE else None
 
 	def _download(self, url, target, overwrite):
 		if not target:
 			target = BytesIO()
-		if url in self._downloads:
-			known_state = self.get_state(url)
-			if known_state \
-			and not isinstance(known_state, DownloadException) \
-			and not overwrite:
+		with self._lock:
+			status, _ = self._status(url)
+			if status is not None and status != Status.FAILED and not overwrite:
 				return
-			else:
-				self.discard_result(url)
+			if isinstance(target, str) and exists(target) and not overwrite:
+				# Give taget is a string, we assume its a file path, and an
+				# existing file is what the download would have written
+				self._downloads[url] = (Status.DONE, target)
+				return
+			self._downloads[url] = (Status.DOWNLOADING, None)
 		try:
 			if isinstance(target, str):
-				# Give taget is a string, we assume its a file path
-				if exists(target) and not overwrite:
-					return
 				dest = open(target, 'wb')
 			else:
 				# If not a filepath, must be a stream right?
 				dest = target
-			self._downloads[url] = Downloading(url)
 			bio = download_bytes(url)
 			dest.write(bio.getvalue())
 			if dest != target:
 				dest.close()
-			self._downloads[url] = Done(url, target)
+			self._downloads[url] = (Status.DONE, target)
 		except Exception as e:
-			self._downloads[url] = DownloadException(url, e)
+			self._downloads[url] = (Status.FAILED, _picklable(e))
 
 	def _record_handler(self, url, target, overwrite):
 		logger.debug('Downloading %s' % (url))
 		self._download(url, target, overwrite)
 
-	def download(self, url, target, async=True, overwrite=False):
+	def download(self, url, target, async_=True, overwrite=False, **kwds):
 		"""Downloads the given url to the specified target.
 
 		Warning: using buffers as targets could be problematic.
@@ -134,26 +163,60 @@ class DownloadPool(AbstractQueueConsumer):
 		Keyword arguments:
 		url -- the source url to be downloaded
 		target -- the dest to write the received bytes (default BytesIO())
-		async -- do we wait for the download to complete? (default True)
+		async_ -- do we wait for the download to complete? (default True)
 		overwrite -- do we overwrite existing files? (default False)
 		"""
+		async_ = _async_argument(async_, kwds)
 		result = DownloadResult(url)
-		if not async:
+		if not async_:
 			self._download(url, target, overwrite)
 			self.wait(result)
 		else:
 			self._put(url, target, overwrite)
 		return result
 
+def _picklable(e):
+	"""Returns e, or its repr if it does not pickle, so that it can be sent to
+	callers of the manager. HTTPError, for one, holds its response."""
+	try:
+		pickle.dumps(e)
+		return e
+	except Exception:
+		return repr(e)
+
+def _async_argument(async_, kwds):
+	"""Takes the async_ argument from its former name 'async', a keyword since
+	Python 3.7, if that is how it was given"""
+	if 'async' in kwds:
+		async_ = kwds.pop('async')
+	if kwds:
+		raise TypeError('Unexpected keyword arguments %s' % ', '.join(kwds))
+	return async_
+
 class DownloadManager(BaseManager): pass
 
 DownloadManager.register('DownloadPool', DownloadPool)
 
-__download_manager = DownloadManager()
-__download_manager.start()
-__download_pool = __download_manager.DownloadPool()
-
-def download(url, target=None, async=True, overwrite=False):
+# The module download manager and pool, started on first use
+__download_manager = None
+__download_pool = None
+__start_lock = Lock()
+
+def _download_pool():
+	"""Returns the global DownloadPool proxy, starting the download manager and
+	its consumers if they are not running yet."""
+	global __download_manager, __download_pool
+	with __start_lock:
+		if __download_pool is None:
+			# Consumers log, let them inherit the logging manager
+			mplogging.start()
+			manager = DownloadManager()
+			manager.start()
+			__download_pool = manager.DownloadPool()
+			__download_manager = manager
+	return __download_pool
+
+def download(url, target=None, async_=True, overwrite=False, **kwds):
 	"""Download a url to the given target.
 
 	If a target is not provided, a new BytesIO object is created and used.
@@ -161,13 +224,14 @@ def download(url, target=None, async=True, overwrite=False):
 	Keyword arguments:
 	url -- the source url to be downloaded
 	target -- the dest to write the received bytes (default BytesIO())
-	async -- do we wait for the download to complete? (default True)
+	async_ -- do we wait for the download to complete? (default True)
 	overwrite -- do we overwrite existing files? (default False)
 	"""
-	return __download_pool.download(url, target, async, overwrite)
+	async_ = _async_argument(async_, kwds)
+	return _download_pool().download(url, target, async_, overwrite)
 
 def fetch_result(result, block=True, discard_done=True):
-	return __download_pool.fetch_download(result, block, discard_done)
+	return _download_pool().fetch_download(result, block, discard_done)
 
 def download_async(url, target=None, overwrite=False):
 	return download(url, target, True, overwrite)
@@ -177,6 +241,7 @@ def download_blocking(url, target=None, overwrite=False):
 
 @atexit.register
 def __close_active_pools():
-	"""Triggers shutdown on exit"""
-	# We wait infinitely for downloads to finish
-	__download_pool.shutdown(None)
+	"""Triggers shutdown on exit, if the pool was started"""
+	if __download_pool is not None:
+		# We wait infinitely for downloads to finish
+		__download_pool.shutdown(None)
@@ -0,0 +1,223 @@
+import os
+from base64 import b64encode
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.request import getproxies, proxy_bypass
+
+PROBE_TIMEOUT = 1
+PROBE_CONCURRENCY = 16
+PROBE_CACHE_TTL = 300
+PROBE_USER_AGENT = 'python'
+MAX_REDIRECTS = 5
+# Idle connections kept per host
+MAX_IDLE_CONNECTIONS = 4
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# Servers answering HEAD with these are probed with a ranged GET instead
+HEAD_REJECTED_STATUSES = (400, 403, 405, 501)
+
+# What a probe learnt about a url. status is None if the request failed, with
+# error describing why; size is None if the server did not tell.
+ProbeResult = namedtuple('ProbeResult', ['url', 'status', 'size',
+	'accepts_ranges', 'etag', 'last_modified', 'final_url', 'error'])
+
+def _proxy(scheme, netloc):
+	"""Returns the proxy configured in the environment for a host, as its
+	host and port and the Proxy-Authorization header it needs, or None"""
+	proxy = getproxies().get(scheme)
+	if not proxy or proxy_bypass(netloc):
+		return None
+	if '://' not in proxy:
+		proxy = 'http://' + proxy
+	parts = urlsplit(proxy)
+	authorization = None
+	if parts.username is not None:
+		creds = '%s:%s' % (unquote(parts.username), unquote(parts.password or ''))
+		authorization = 'Basic ' + b64encode(creds.encode()).decode()
+	return parts.netloc.rpartition('@')[2], authorization
+
+class _ConnectionPool():
+	"""Idle HTTP connections by scheme, host, port and proxy, shared by the
+	threads of a process. A connection is only ever used by one thread at a
+	time. Connections to https hosts are tunnelled through their proxy."""
+	def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+		self.max_idle = max_idle
+		self._idle = {}
+		self._lock = Lock()
+		self._pid = os.getpid()
+
+	def get(self, scheme, netloc, timeout, proxy=None):
+		with self._lock:
+			if self._pid != os.getpid():
+				# Sockets inherited from the parent must not be shared
+				self._idle = {}
+				self._pid = os.getpid()
+			idle = self._idle.get((scheme, netloc, proxy))
+			if idle:
+				conn = idle.pop()
+				conn.timeout = timeout
+				if conn.sock is not None:
+					conn.sock.settimeout(timeout)
+				return conn
+		host = netloc if proxy is None else proxy[0]
+		if scheme == 'https':
+			conn = HTTPSConnection(host, timeout=timeout)
+			if proxy is not None:
+				headers = None
+				if proxy[1] is not None:
+					headers = {'Proxy-Authorization': proxy[1]}
+				conn.set_tunnel(netloc, headers=headers)
+			return conn
+		return HTTPConnection(host, timeout=timeout)
+
+	def put(self, scheme, netloc, conn, proxy=None):
+		with self._lock:
+			idle = self._idle.setdefault((scheme, netloc, proxy), [])
+			if len(idle) < self.max_idle and self._pid == os.getpid():
+				idle.append(conn)
+				return
+		conn.close()
+
+	def clear(self):
+		with self._lock:
+			idle, self._idle = self._idle, {}
+		for conns in idle.values():
+			for conn in conns:
+				conn.close()
+
+class ProbeCache():
+	"""Probe results by url, each kept for ttl seconds"""
+	def __init__(self, ttl=PROBE_CACHE_TTL):
+		self.ttl = ttl
+		self._results = {}
+		self._lock = Lock()
+
+	def get(self, url):
+		with self._lock:
+			entry = self._results.get(url)
+			if entry is None:
+				return None
+			expires, result = entry
+			if expires < monotonic():
+				del self._results[url]
+				return None
+			return result
+
+	def put(self, url, result):
+		with self._lock:
+			self._results[url] = (monotonic() + self.ttl, result)
+
+	def clear(self):
+		with self._lock:
+			self._results.clear()
+
+_pool = _ConnectionPool()
+_cache = ProbeCache()
+
+def pooled_request(method, url, headers=None, timeout=PROBE_TIMEOUT):
+	"""Sends a request over a pooled connection. Returns the response and its
+	body. The body is only read for partial content, HEAD requests and
+	statuses of 300 and up; it is None otherwise, and the connection is then
+	closed rather than pooled.
+
+	Requests go through the proxies of the environment, as with urlopen(),
+	see urllib.request.getproxies()."""
+	parts = urlsplit(url)
+	path = parts.path or '/'
+	if parts.query:
+		path += '?' + parts.query
+	headers = dict(headers or {}, **{'User-Agent': PROBE_USER_AGENT})
+	proxy = _proxy(parts.scheme, parts.netloc)
+	if proxy is not None and parts.scheme == 'http':
+		# Plain requests are sent to the proxy with the full url
+		path = '%s://%s%s' % (parts.scheme, parts.netloc, path)
+		if proxy[1] is not None:
+			headers['Proxy-Authorization'] = proxy[1]
+	# A pooled connection may have been closed by the server meanwhile, in
+	# which case the request is retried once on a fresh one
+	for attempt in range(2):
+		conn = _pool.get(parts.scheme, parts.netloc, timeout, proxy)
+		reused = conn.sock is not None
+		try:
+			conn.request(method, path, headers=headers)
+			response = conn.getresponse()
+			body = None
+			ranged = response.status == 206 or method == 'HEAD'
+			if ranged or response.status >= 300:
+				body = response.read()
+		except Exception:
+			conn.close()
+			if reused and attempt == 0:
+				continue
+			raise
+		if response.will_close or not response.isclosed():
+			# Never drain a full body just to reuse the connection
+			conn.close()
+		else:
+			_pool.put(parts.scheme, parts.netloc, conn, proxy)
+		return response, body
+
+def content_size(response):
+	"""Returns the full size of a resource from a response, if it tells"""
+	content_range = response.getheader('Content-Range')
+	if content_range and '/' in content_range:
+		total = content_range.rsplit('/', 1)[1].strip()
+		return int(total) if total.isdigit() else None
+	length = response.getheader('Content-Length')
+	if length and length.isdigit() and response.status != 206:
+		return int(length)
+	return None
+
+def _probe(url, timeout):
+	target = url
+	try:
+		for _ in range(MAX_REDIRECTS + 1):
+			response, _ = pooled_request('HEAD', target, None, timeout)
+			if response.status in HEAD_REJECTED_STATUSES:
+				response, _ = pooled_request('GET', target,
+									{'Range': 'bytes=0-0'}, timeout)
+			location = response.getheader('Location')
+			if response.status in REDIRECT_STATUSES and location:
+				target = urljoin(target, location)
+				continue
+			break
+		accepts_ranges = response.status == 206 \
+			or response.getheader('Accept-Ranges', '').lower() == 'bytes'
+		return ProbeResult(url, response.status, content_size(response),
+			accepts_ranges, response.getheader('ETag'),
+			response.getheader('Last-Modified'), target, None)
+	except Exception as e:
+		return ProbeResult(url, None, None, False, None, None, target, repr(e))
+
+def probe(url, timeout=PROBE_TIMEOUT, cache=_cache):
+	"""Probes a url with a HEAD request, falling back to a GET of its first
+	byte if HEAD is rejected, and following redirects. Returns a ProbeResult.
+
+	Results of requests that got a response are cached, pass cache=None to
+	always send a request."""
+	if cache is not None:
+		result = cache.get(url)
+		if result is not None:
+			return result
+	result = _probe(url, timeout)
+	if cache is not None and result.status is not None:
+		cache.put(url, result)
+	return result
+
+def probe_many(urls, concurrency=PROBE_CONCURRENCY, timeout=PROBE_TIMEOUT,
+			cache=_cache):
+	"""Probes urls concurrently, see probe(). Returns a dict of the
+	ProbeResult of each url."""
+	urls = list(dict.fromkeys(urls))
+	if not urls:
+		return {}
+	with ThreadPoolExecutor(min(concurrency, len(urls))) as executor:
+		results = executor.map(lambda url: probe(url, timeout, cache), urls)
+		return dict(zip(urls, results))
+
+def clear_probe_cache():
+	_cache.clear()
@@ -0,0 +1,164 @@
+import re
+from collections import OrderedDict
+from io import RawIOBase, SEEK_SET, SEEK_CUR, SEEK_END
+from pyrus.web.probe import probe, pooled_request, content_size
+
+RANGE_BLOCK_SIZE = 64 << 10
+RANGE_CACHE_BLOCKS = 256
+RANGE_MAX_READ_AHEAD = 16
+RANGE_TIMEOUT = 30
+
+class RangeNotSupportedException(Exception): pass
+
+_content_range = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)$')
+
+def _served_range(response):
+	"""Returns the first and last byte positions of a partial response"""
+	match = _content_range.match(response.getheader('Content-Range') or '')
+	if match is None:
+		return None
+	return int(match.group(1)), int(match.group(2))
+
+def _validator(etag, last_modified):
+	"""Returns the validator to send in If-Range, which takes no weak ETag"""
+	if etag and not etag.startswith('W/'):
+		return etag
+	return last_modified
+
+class HTTPRangeFile(RawIOBase):
+	"""A read-only, seekable file object over a remote resource, read with
+	HTTP Range requests. Only the blocks that are read are transferred.
+
+	Blocks are kept in an LRU cache of cache_blocks blocks. Missing blocks
+	needed by a read are fetched in a single request; while reads are
+	sequential each request also fetches ahead, doubling up to max_read_ahead
+	blocks. Requests carry the resource validator in If-Range, so a resource
+	changing under the reader raises RangeNotSupportedException instead of
+	mixing versions."""
+	def __init__(self, url, block_size=RANGE_BLOCK_SIZE,
+				cache_blocks=RANGE_CACHE_BLOCKS,
+				max_read_ahead=RANGE_MAX_READ_AHEAD, timeout=RANGE_TIMEOUT):
+		RawIOBase.__init__(self)
+		self.block_size = block_size
+		self.cache_blocks = cache_blocks
+		self.max_read_ahead = max_read_ahead
+		self.timeout = timeout
+		result = probe(url, timeout, cache=None)
+		if result.status is None:
+			raise IOError('%s: %s' % (url, result.error))
+		if result.status >= 400:
+			raise IOError('%s: HTTP status %d' % (url, result.status))
+		self.name = url
+		# Redirects are only followed once
+		self.url = result.final_url
+		self.size = result.size
+		self.validator = _validator(result.etag, result.last_modified)
+		# Counters of the transfers made so far
+		self.requests = 0
+		self.bytes_fetched = 0
+		self._pos = 0
+		self._blocks = OrderedDict()
+		self._read_ahead = 1
+		self._next_block = None
+		if self.size is None or not result.accepts_ranges:
+			# Confirms range support, and learns the size if needed
+			self._fetch(0, 0)
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self._pos
+
+	def seek(self, offset, whence=SEEK_SET):
+		if whence == SEEK_SET:
+			pos = offset
+		elif whence == SEEK_CUR:
+			pos = self._pos + offset
+		elif whence == SEEK_END:
+			pos = self.size + offset
+		else:
+			raise ValueError('Invalid whence %r' % (whence,))
+		if pos < 0:
+			raise ValueError('Negative seek position %d' % pos)
+		self._pos = pos
+		return pos
+
+	def readinto(self, b):
+		view = memoryview(b).cast('B')
+		wanted = max(0, min(len(view), self.size - self._pos))
+		done = 0
+		# Bounded so that a large read never evicts its own blocks
+		step = max(1, self.cache_blocks // 2)
+		while done < wanted:
+			start = self._pos + done
+			first = start // self.block_size
+			end = min((first + step) * self.block_size, self._pos + wanted)
+			last = (end - 1) // self.block_size
+			self._ensure(first, last)
+			for index in range(first, last + 1):
+				block = self._blocks[index]
+				offset = index * self.block_size
+				lo, hi = max(start, offset), min(end, offset + len(block))
+				view[done:done + hi - lo] = block[lo - offset:hi - offset]
+				done += hi - lo
+		self._pos += done
+		return done
+
+	def _ensure(self, first, last):
+		"""Makes sure blocks first to last are cached, fetching the missing
+		ones and, on sequential reads, the ones after them."""
+		if first == self._next_block:
+			self._read_ahead = min(self.max_read_ahead, self._read_ahead * 2)
+		else:
+			self._read_ahead = 1
+		self._next_block = last + 1
+		missing = [ i for i in range(first, last + 1) if i not in self._blocks ]
+		for index in range(first, last + 1):
+			if index in self._blocks:
+				self._blocks.move_to_end(index)
+		if missing:
+			blocks = (self.size + self.block_size - 1) // self.block_size
+			# Reading ahead must leave room for the blocks being read
+			ahead = min(self._read_ahead - 1, self.cache_blocks - (last - first + 1))
+			end = min(blocks - 1, last + max(0, ahead))
+			self._fetch(missing[0], end)
+
+	def _fetch(self, first, last):
+		"""Fetches and caches blocks first to last in one request"""
+		start = first * self.block_size
+		end = (last + 1) * self.block_size - 1
+		if self.size is not None:
+			end = min(end, self.size - 1)
+		headers = {'Range': 'bytes=%d-%d' % (start, end)}
+		if self.validator:
+			headers['If-Range'] = self.validator
+		response, body = pooled_request('GET', self.url, headers, self.timeout)
+		self.requests += 1
+		if response.status != 206:
+			raise RangeNotSupportedException('%s: HTTP status %d to a range '
+				'request, it changed or does not support ranges'
+				% (self.url, response.status))
+		served = _served_range(response)
+		if served is None or served[0] != start \
+		or len(body) != served[1] - served[0] + 1:
+			raise IOError('%s: got range %r and %d bytes for bytes %d-%d'
+				% (self.url, response.getheader('Content-Range'), len(body),
+				start, end))
+		if self.size is None:
+			self.size = content_size(response)
+			if self.size is None:
+				raise RangeNotSupportedException('%s: unknown size' % self.url)
+		if self.validator is None:
+			self.validator = _validator(response.getheader('ETag'),
+									response.getheader('Last-Modified'))
+		self.bytes_fetched += len(body)
+		for i in range(0, len(body), self.block_size):
+			index = first + i // self.block_size
+			self._blocks[index] = body[i:i + self.block_size]
+			self._blocks.move_to_end(index)
+		while len(self._blocks) > self.cache_blocks:
+			self._blocks.popitem(last=False)
@@ -0,0 +1,380 @@
+import os
+import tarfile
+import zipfile
+from io import BytesIO
+from pyrus.archives import ZipFile, TarFile, MemberType
+
+CONTENTS = {
+	'a.txt': b'alpha',
+	'dir/b.bin': b'\x00' * 4096,
+	'dir/c.txt': b'charlie',
+	}
+
+def make_zip():
+	bio = BytesIO()
+	with zipfile.ZipFile(bio, 'w', zipfile.ZIP_DEFLATED) as zf:
+		zf.writestr('dir/', b'')
+		for name, data in sorted(CONTENTS.items()):
+			zf.writestr(name, data)
+	bio.seek(0)
+	return bio
+
+def make_tar():
+	bio = BytesIO()
+	with tarfile.open(fileobj=bio, mode='w') as tf:
+		info = tarfile.TarInfo('dir')
+		info.type = tarfile.DIRTYPE
+		tf.addfile(info)
+		for name, data in sorted(CONTENTS.items()):
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			tf.addfile(info, BytesIO(data))
+	bio.seek(0)
+	return bio
+
+def _collect(archive, **filters):
+	result = {}
+	for info, stream in archive.iter_members(**filters):
+		name = archive.filename_from_info(info).rstrip('/')
+		result[name] = stream.read() if stream else None
+	return result
+
+def test_iter_members_zip():
+	archive = ZipFile('test.zip', make_zip())
+	members = _collect(archive)
+	assert members.pop('dir') is None
+	assert members == CONTENTS
+
+def test_iter_members_tar():
+	archive = TarFile('test.tar', make_tar())
+	members = _collect(archive)
+	assert members.pop('dir') is None
+	assert members == CONTENTS
+
+def test_iter_members_filters():
+	for archive in (ZipFile('test.zip', make_zip()),
+					TarFile('test.tar', make_tar())):
+		assert list(_collect(archive, pattern='*.txt')) == ['a.txt', 'dir/c.txt']
+		assert list(_collect(archive, min_size=100)) == ['dir/b.bin']
+		assert list(_collect(archive, types=[MemberType.DIR])) == ['dir']
+
+def test_parallel_extract_all_zip():
+	archive = ZipFile('test.zip', make_zip())
+	files = archive.extract_all(workers=2)
+	assert files.pop('dir/').read() == b''
+	assert dict((k, v.read()) for k, v in files.items()) == CONTENTS
+
+def test_walk_archive_nested():
+	from hashlib import md5
+	from pyrus.archives import walk_archive
+	jar = make_zip().getvalue()
+	tgz = BytesIO()
+	with tarfile.open(fileobj=tgz, mode='w:gz') as tf:
+		info = tarfile.TarInfo('lib/inner.jar')
+		info.size = len(jar)
+		tf.addfile(info, BytesIO(jar))
+	outer = BytesIO()
+	with zipfile.ZipFile(outer, 'w') as zf:
+		zf.writestr('outer.tar.gz', tgz.getvalue())
+		zf.writestr('readme', b'top')
+	outer.seek(0)
+	records = dict((r.path, r) for r in walk_archive('outer.zip', fileobj=outer,
+					algorithm='md5', types=[MemberType.FILE]))
+	assert set(records) == set([('readme',)] + [
+		('outer.tar.gz', 'lib/inner.jar', name) for name in CONTENTS])
+	record = records[('outer.tar.gz', 'lib/inner.jar', 'dir/c.txt')]
+	assert record.stream.read() == CONTENTS['dir/c.txt']
+	assert record.digest == md5(CONTENTS['dir/c.txt']).hexdigest()
+	outer.seek(0)
+	shallow = [ r.path for r in walk_archive('outer.zip', 1, outer) ]
+	assert shallow == [('outer.tar.gz',), ('readme',)]
+
+def test_walk_archive_not_nested():
+	# Members named and compressed like tars, that are not tars inside
+	import bz2, os
+	from pyrus.archives import walk_archive
+	members = [('notes.tar.bz2', bz2.compress(os.urandom(1 << 20))),
+		('plain.tar.bz2', bz2.compress(b'just text\n' * 100)),
+		('fake.tar', b'\0' * 257 + b'ustar' + b'\0' * 3000), ('readme', b'top')]
+	outer = BytesIO()
+	with tarfile.open(fileobj=outer, mode='w') as tf:
+		for name, data in members:
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			tf.addfile(info, BytesIO(data))
+	outer.seek(0)
+	records = [ (r.path, r.stream.read()) for r in walk_archive('outer.tar',
+																fileobj=outer) ]
+	assert records == [ ((name,), data) for name, data in members ]
+
+def test_native_tar_listing(tmp_path):
+	from pyrus.archives import NativeTarFile
+	path = str(tmp_path / 'native.tar')
+	with tarfile.open(path, 'w') as tf:
+		info = tarfile.TarInfo('a b -> c.txt')
+		info.size = 3
+		info.mode = 0o4755
+		tf.addfile(info, BytesIO(b'abc'))
+		info = tarfile.TarInfo('link name')
+		info.type = tarfile.SYMTYPE
+		info.linkname = 'a b -> c.txt'
+		tf.addfile(info)
+	archive = NativeTarFile(path)
+	regular, link = archive.infolist()
+	assert archive.filelist == ['a b -> c.txt', 'link name']
+	assert (regular.filesize, regular.mode) == (3, 0o104755)
+	assert link.issym() and link.linkto == 'a b -> c.txt'
+
+def test_tar_index(tmp_path):
+	import gzip
+	from pyrus.archives import TarIndex
+	plain = tmp_path / 'index.tar'
+	plain.write_bytes(make_tar().getvalue())
+	# Two gzip members, as written by pigz --independent or bgzip
+	data = plain.read_bytes()
+	compressed = tmp_path / 'index.tar.gz'
+	compressed.write_bytes(gzip.compress(data[:1024]) + gzip.compress(data[1024:]))
+	for path in (str(plain), str(compressed)):
+		index = TarIndex.build(path, spacing=512)
+		index.save()
+		loaded = TarIndex.load(path)
+		assert sorted(loaded.names()) == sorted(['dir'] + list(CONTENTS))
+		for name, content in CONTENTS.items():
+			assert index.open_member(name).read() == content
+			assert loaded.open_member(name).read() == content
+		assert loaded.open_member('dir') is None
+	assert len(TarIndex.load(str(compressed)).checkpoints) == 2
+	archive = TarFile(str(plain), index=TarIndex.load(str(plain)))
+	assert archive.extract('dir/c.txt').read() == CONTENTS['dir/c.txt']
+
+def test_native_tar_stdin():
+	import gzip
+	from pyrus.archives import NativeTarFile
+	fileobj = BytesIO(gzip.compress(make_tar().getvalue()))
+	archive = NativeTarFile('test.tar.gz', fileobj, inmemory_processing=True)
+	assert archive.extract('dir/c.txt').read() == CONTENTS['dir/c.txt']
+	values = [ v.read() for v in archive.extract_all() ]
+	assert values == [b''] + [ CONTENTS[n] for n in sorted(CONTENTS) ]
+	assert _collect(archive, pattern='*.txt') == {
+		'a.txt': CONTENTS['a.txt'], 'dir/c.txt': CONTENTS['dir/c.txt']}
+
+def test_sniff_archive_type():
+	import bz2, gzip, lzma
+	from pyrus.archives import sniff_archive_type, is_archive, ArchiveType
+	plain = make_tar().getvalue()
+	v7 = BytesIO()
+	with tarfile.open(fileobj=v7, mode='w', format=tarfile.GNU_FORMAT) as tf:
+		tf.addfile(tarfile.TarInfo('empty'))
+	v7 = bytearray(v7.getvalue())
+	v7[257:265] = bytes(8)
+	v7[148:156] = b'%06o\x00 ' % (sum(v7[:148]) + 256 + sum(v7[156:512]))
+	cases = [
+		(make_zip().getvalue(), None, ArchiveType.ZIP),
+		(plain, None, ArchiveType.TAR),
+		(bytes(v7), None, ArchiveType.TAR),
+		(gzip.compress(plain), None, ArchiveType.GZIP),
+		(lzma.compress(plain), None, ArchiveType.XZ),
+		(bz2.compress(plain), 'x.tar.bz2', ArchiveType.BZIP2),
+		(bz2.compress(b'text'), 'x.txt.bz2', None),
+		(gzip.compress(b'text' * 100), None, None),
+		(b'text' * 1000, None, None),
+		]
+	for data, name, expected in cases:
+		assert sniff_archive_type(data[:4096], name) == expected
+		if name is None:
+			assert is_archive(BytesIO(data)) == (expected is not None)
+	# A zip behind a launcher script, found by its central directory
+	from pyrus.archives import make_archive_obj
+	stubbed = BytesIO(b'#!/bin/sh\nexec java -jar "$0"\n' + make_zip().getvalue())
+	assert sniff_archive_type(stubbed.getvalue()[:4096]) is None
+	assert is_archive(stubbed) and stubbed.tell() == 0
+	archive = make_archive_obj('launcher.jar', stubbed)
+	assert isinstance(archive, ZipFile)
+	assert archive.extract('dir/c.txt').read() == CONTENTS['dir/c.txt']
+
+def test_writers_copy_members():
+	from pyrus.archives import ZipWriter, TarWriter, ArchiveType
+	for workers in (1, 3):
+		bio = BytesIO()
+		with ZipWriter('copy.zip', bio, level=9, workers=workers) as writer:
+			writer.copy_members(ZipFile('test.zip', make_zip()), pattern='dir*')
+			writer.add_bytes('extra.txt', b'extra' * 100)
+		copied = ZipFile('copy.zip', bio)
+		members = _collect(copied)
+		assert members.pop('dir') is None
+		assert members.pop('extra.txt') == b'extra' * 100
+		assert members == dict((k, v) for k, v in CONTENTS.items()
+							if k.startswith('dir'))
+		assert copied.archive.testzip() is None
+	bio = BytesIO()
+	with TarWriter('copy.tar.gz', bio, archive_type=ArchiveType.GZIP) as writer:
+		writer.copy_members(TarFile('test.tar', make_tar()))
+		writer.copy_members(ZipFile('test.zip', make_zip()), pattern='a.txt')
+		writer.add_stream('streamed', BytesIO(b'stream'))
+	bio.seek(0)
+	members = _collect(TarFile('copy.tar.gz', bio))
+	assert members.pop('dir') is None
+	assert members.pop('streamed') == b'stream'
+	assert members == CONTENTS
+
+def test_parallel_gzip_round_trip():
+	import gzip
+	from pyrus.archives import TarWriter, ArchiveType, ParallelGzipReader
+	bio = BytesIO()
+	big = bytes(range(256)) * 20000
+	with TarWriter('par.tar.gz', bio, workers=3,
+				archive_type=ArchiveType.GZIP) as writer:
+		writer.copy_members(TarFile('test.tar', make_tar()))
+		writer.add_bytes('big', big)
+	plain = gzip.decompress(bio.getvalue())
+	reader = ParallelGzipReader(BytesIO(bio.getvalue()), 3)
+	assert len(reader.members) > 1
+	assert reader.read() == plain
+	reader.seek(len(plain) // 2)
+	assert reader.read(1000) == plain[len(plain) // 2:len(plain) // 2 + 1000]
+	bio.seek(0)
+	members = _collect(TarFile('par.tar.gz', bio, workers=3))
+	assert members.pop('dir') is None
+	assert members.pop('big') == big
+	assert members == CONTENTS
+
+def _link_tar(path, links, files=()):
+	with tarfile.open(path, 'w') as tf:
+		for name, target in links:
+			info = tarfile.TarInfo(name)
+			info.type = tarfile.SYMTYPE
+			info.linkname = target
+			tf.addfile(info)
+		for name in files:
+			info = tarfile.TarInfo(name)
+			info.size = 4
+			tf.addfile(info, BytesIO(b'data'))
+
+def test_safe_extraction(tmp_path):
+	import pytest
+	from pyrus.archives import UnsafeArchiveException
+	path = str(tmp_path / 'unsafe.tar')
+	_link_tar(path, [], ['a/../../x'])
+	with pytest.raises(UnsafeArchiveException):
+		TarFile(path, inmemory_processing=False)
+	unsafe = [
+		([('l', '/etc')], []),
+		([('l', '../..')], []),
+		([('d', '.'), ('e', 'd/..')], []),
+		([('d', 'sub/..'), ('sub', '.')], ['d/f']),
+		([('e', 'd/..'), ('d', '.')], []),
+		([('d', 'x'), ('e', 'd/..'), ('d', '.')], []),
+		]
+	for links, files in unsafe:
+		_link_tar(path, links, files)
+		archive = TarFile(path, inmemory_processing=False)
+		with pytest.raises(UnsafeArchiveException):
+			archive.extract_all()
+	_link_tar(path, [('x/up', '../sub/f')], ['sub/f'])
+	archive = TarFile(path, inmemory_processing=False)
+	files = archive.extract_all()
+	assert open(files['x/up'], 'rb').read() == b'data'
+	from pyrus.archives import is_unsafe_name
+	assert is_unsafe_name('C:/x') and is_unsafe_name('c:x')
+	assert not is_unsafe_name('1:2') and not is_unsafe_name('_:x')
+	_link_tar(path, [('d', 'sub')], ['sub/f', 'd/g'])
+	archive = TarFile(path, inmemory_processing=False)
+	files = archive.extract_all()
+	assert open(files['d/g'], 'rb').read() == b'data'
+	assert os.path.realpath(files['d/g']) == \
+		os.path.join(os.path.realpath(archive.tempdir), 'sub', 'g')
+
+def test_safe_extraction_zip(tmp_path):
+	path = str(tmp_path / 'stored.zip')
+	with zipfile.ZipFile(path, 'w') as zf:
+		for name, data in CONTENTS.items():
+			zf.writestr(name, data)
+	archive = ZipFile(path, inmemory_processing=False)
+	files = archive.extract_all()
+	for name, data in CONTENTS.items():
+		assert open(files[name], 'rb').read() == data
+
+def test_parallel_extract_all_zip_fileobj(tmp_path):
+	from pyrus.archives import PARALLEL_BATCH_BYTES
+	path = str(tmp_path / 'big.zip')
+	# Incompressible, so workers spend their time reading the archive
+	contents = dict(('m%d' % i, os.urandom(PARALLEL_BATCH_BYTES))
+				for i in range(6))
+	with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+		for name, data in contents.items():
+			zf.writestr(name, data)
+	with open(path, 'rb') as f:
+		files = ZipFile(path, f).extract_all(workers=6)
+	assert dict((k, v.read()) for k, v in files.items()) == contents
+
+def test_native_tar_stdin_concurrent_streams():
+	import gzip
+	from pyrus.archives import NativeTarFile
+	contents = {'x': os.urandom(1 << 20) * 3, 'y': os.urandom(1 << 20) * 3}
+	bio = BytesIO()
+	with tarfile.open(fileobj=bio, mode='w') as tf:
+		for name, data in sorted(contents.items()):
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			tf.addfile(info, BytesIO(data))
+	fileobj = BytesIO(gzip.compress(bio.getvalue(), 1))
+	archive = NativeTarFile('test.tar.gz', fileobj, inmemory_processing=True)
+	first, second = archive.extract('x'), archive.extract('y')
+	assert second.read() == contents['y']
+	assert first.read() == contents['x']
+
+def test_zip_writer_fallbacks(tmp_path, monkeypatch):
+	from pyrus import archives
+	from pyrus.archives import ZipWriter, TarWriter
+	path = tmp_path / 'file.txt'
+	path.write_bytes(b'on disk')
+	# Members over the size limit, and writers without the zipfile internals
+	# for raw writes, compress on the calling thread
+	monkeypatch.setattr(archives, 'ZIP_PARALLEL_MEMBER_SIZE', 1000)
+	for raw in (True, False):
+		monkeypatch.setattr(archives, '_raw_writes_supported', lambda a: raw)
+		bio = BytesIO()
+		with ZipWriter('fallback.zip', bio, workers=3) as writer:
+			assert (writer.pool is not None) == raw
+			writer.copy_members(ZipFile('test.zip', make_zip()))
+			writer.add_stream('big', BytesIO(b'b' * 5000))
+			writer.add_file(str(path))
+		members = _collect(ZipFile('fallback.zip', bio))
+		assert members.pop('dir') is None
+		assert members.pop('big') == b'b' * 5000
+		assert members.pop(str(path).lstrip('/')) == b'on disk'
+		assert members == CONTENTS
+	bio = BytesIO()
+	with TarWriter('names.tar', bio) as writer:
+		writer.add_file(str(path))
+	bio.seek(0)
+	assert tarfile.open(fileobj=bio).getnames() == [str(path).lstrip('/')]
+
+def _bgzip(data, block_size=1000):
+	"""Compresses data the way bgzip does, ending with its empty EOF block"""
+	import struct, zlib
+	out = []
+	for start in list(range(0, len(data), block_size)) + [len(data)]:
+		block = data[start:start + block_size]
+		compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+		deflated = compressor.compress(block) + compressor.flush()
+		header = b'\x1f\x8b\x08\x04' + struct.pack('<IBBH2sHH', 0, 0, 255, 6,
+									b'BC', 2, 18 + len(deflated) + 8 - 1)
+		out += [header, deflated,
+			struct.pack('<II', zlib.crc32(block), len(block))]
+	return b''.join(out)
+
+def test_parallel_gzip_bgzip(tmp_path):
+	from pyrus.archives import ParallelGzipReader, is_parallel_gzip
+	path = str(tmp_path / 'bgzip.tar.gz')
+	plain = make_tar().getvalue()
+	with open(path, 'wb') as f:
+		f.write(_bgzip(plain))
+	assert is_parallel_gzip(open(path, 'rb').read(4096))
+	with TarFile(path, workers=3) as archive:
+		assert isinstance(archive.reader, ParallelGzipReader)
+		assert len(archive.reader.members) > 2
+		members = _collect(archive)
+	assert archive.reader.fileobj.closed
+	assert members.pop('dir') is None
+	assert members == CONTENTS
@@ -0,0 +1,134 @@
+import asyncio
+from pyrus import AbstractQueueConsumer, Backend, Overflow, SharedStateTable
+
+class _Recorder(AbstractQueueConsumer):
+	def _initialize(self, consumers, *args):
+		self.seen = SharedStateTable(64)
+		AbstractQueueConsumer._initialize(self, consumers, *args)
+
+	def _record_handler(self, key, value):
+		self.seen[key] = value
+
+class _AsyncRecorder(_Recorder):
+	async def _record_handler(self, key, value):
+		await asyncio.sleep(0)
+		self.seen[key] = value
+
+def _check(cls, backend):
+	# Each borg class shares its state, so every run needs a class of its own
+	consumer = type(cls.__name__ + backend, (cls,), {})(3, backend)
+	for i in range(20):
+		consumer._put('key%d' % i, i)
+	consumer.shutdown(None)
+	assert [ consumer.seen.get('key%d' % i) for i in range(20) ] == list(range(20))
+
+def test_backends():
+	for backend in (Backend.PROCESS, Backend.THREAD, Backend.ASYNCIO):
+		_check(_Recorder, backend)
+	_check(_AsyncRecorder, Backend.ASYNCIO)
+
+def test_flush_keeps_consumers():
+	from time import monotonic
+	for backend in (Backend.PROCESS, Backend.THREAD, Backend.ASYNCIO):
+		consumer = type('Flush' + backend, (_Recorder,), {})(2, backend)
+		for i in range(10):
+			consumer._put('key%d' % i, i)
+		assert consumer.flush(10)
+		assert consumer.seen.get('key9') == 9
+		consumer._put('after', 1)
+		start = monotonic()
+		consumer.shutdown()
+		assert monotonic() - start < 1
+		assert consumer.seen.get('after') == 1
+		assert not any(w.is_alive() for w in consumer._workers)
+
+class _Slow(_Recorder):
+	def _record_handler(self, key, value):
+		from time import sleep
+		sleep(0.01)
+		_Recorder._record_handler(self, key, value)
+
+def test_overflow_policies():
+	from queue import Full
+	for backend in (Backend.PROCESS, Backend.THREAD, Backend.ASYNCIO):
+		for overflow in (Overflow.DROP_OLDEST, Overflow.DROP_NEWEST,
+						Overflow.SAMPLE):
+			cls = type('Overflow' + backend + overflow, (_Slow,), {})
+			consumer = cls(1, backend, 4, overflow)
+			for i in range(40):
+				consumer._put('key%d' % i, i)
+			consumer.shutdown(None)
+			stats = consumer.queue_stats()
+			handled = sum(1 for i in range(40) if 'key%d' % i in consumer.seen)
+			assert stats['dropped'] > 0
+			assert stats['dropped'] + handled == 40
+			assert stats['outstanding'] == 0
+			assert stats['high_water'] <= 4 + 1 + 1
+			if overflow == Overflow.DROP_OLDEST:
+				assert consumer.seen.get('key39') == 39
+			elif overflow == Overflow.DROP_NEWEST:
+				assert 'key39' not in consumer.seen
+		cls = type('Block' + backend, (_Slow,), {'put_timeout': 0.001})
+		consumer = cls(1, backend, 2)
+		try:
+			for i in range(40):
+				consumer._put('key%d' % i, i)
+		except Full:
+			pass
+		else:
+			assert False, 'queue.Full not raised'
+		assert consumer.flush(10)
+		assert consumer.queue_stats()['dropped'] == 1
+		consumer.shutdown(None)
+
+def test_stats_and_hooks():
+	import pytest
+	for backend in (Backend.PROCESS, Backend.THREAD, Backend.ASYNCIO):
+		# Forked consumers report to shared memory
+		seen = SharedStateTable(64)
+		def hook(cid, record, latency, duration):
+			seen[record[0]] = 2 if duration >= 0.01 else 1
+		consumer = type('Stats' + backend, (_Slow,), {'hooks': (hook,)})(2,
+																backend)
+		if backend == Backend.PROCESS:
+			with pytest.raises(RuntimeError):
+				consumer.add_hook(hook)
+		else:
+			added = []
+			consumer.add_hook(lambda *args: added.append(args[1][0]))
+		dumps = []
+		consumer.dump_stats(0.001, dumps.append)
+		for i in range(10):
+			consumer._put('key%d' % i, i)
+		consumer.flush(10)
+		stats = consumer.stats()
+		consumer.shutdown(None)
+		assert stats['processed'] == 10 and stats['outstanding'] == 0
+		assert sum(c['processed'] for c in stats['consumers']) == 10
+		assert stats['handler']['count'] == 10
+		assert 0.01 <= stats['handler']['p50'] <= 1
+		assert stats['latency']['p99'] >= stats['latency']['p50'] > 0
+		assert dumps and 'depth' in dumps[-1]
+		keys = [ 'key%d' % i for i in range(10) ]
+		assert [ seen.get(key) for key in keys ] == [2] * 10
+		if backend != Backend.PROCESS:
+			assert sorted(added) == sorted(keys)
+
+class _Stuck(_Recorder):
+	def _record_handler(self, key, value):
+		from time import sleep
+		sleep(30)
+
+def test_shutdown_full_queue():
+	from time import monotonic, sleep
+	consumer = type('StuckProcess', (_Stuck,), {})(1, Backend.PROCESS, 1)
+	consumer._put('handled', 0)
+	sleep(0.5)
+	consumer._put('queued', 1)
+	# No room is left for the terminate message, so the deadline applies
+	start = monotonic()
+	consumer.shutdown(0.5)
+	assert monotonic() - start < 2
+	for worker in consumer._workers:
+		worker.join(5)
+	assert not any(w.is_alive() for w in consumer._workers)
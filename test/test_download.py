@@ -0,0 +1,70 @@
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from io import BytesIO
+from pyrus.web.download import DownloadPool, DownloadResult, DownloadException
+from pyrus.web.download import Done
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+	def log_message(self, *args):
+		pass
+
+def _serve(root):
+	handler = partial(_QuietHandler, directory=str(root))
+	server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def test_download_pool(tmp_path):
+	(tmp_path / 'file').write_bytes(b'content')
+	server = _serve(tmp_path)
+	base = 'http://127.0.0.1:%d/' % server.server_port
+	pool = type('TestDownloadPool', (DownloadPool,), {})(2)
+	try:
+		results = [ pool.download(base + 'file?%d' % i, None) for i in range(5) ]
+		for result in results:
+			pool.wait(result)
+			assert pool.fetch_download(result, True).getvalue() == b'content'
+			assert pool.get_state(result.url) is None
+		target = tmp_path / 'copy'
+		result = pool.download(base + 'file', str(target), async_=False)
+		assert isinstance(pool.get_state(result.url), Done)
+		assert target.read_bytes() == b'content'
+		# The former name of async_ is still accepted
+		bio = BytesIO()
+		pool.download(base + 'file?bio', bio, **{'async': False})
+		assert bio.getvalue() == b'content'
+		missing = pool.download(base + 'missing', None)
+		pool.wait(missing)
+		pool.flush()
+		assert isinstance(pool.get_state(missing.url), DownloadException)
+		assert pool.fetch_download(missing) is None
+		stats = pool.stats()
+		assert stats['processed'] == 6 and stats['outstanding'] == 0
+	finally:
+		pool.shutdown()
+		server.shutdown()
+
+class _SlowHandler(_QuietHandler):
+	def do_GET(self):
+		from time import sleep
+		sleep(0.5)
+		_QuietHandler.do_GET(self)
+
+def test_fetch_running_downloads(tmp_path):
+	# Blocking fetches wait for downloads that are still running
+	(tmp_path / 'file').write_bytes(b'content')
+	handler = partial(_SlowHandler, directory=str(tmp_path))
+	server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	base = 'http://127.0.0.1:%d/' % server.server_port
+	pool = type('SlowDownloadPool', (DownloadPool,), {})(4)
+	try:
+		results = [ pool.download(base + 'file?%d' % i, None) for i in range(8) ]
+		assert pool.fetch_download(results[0]) is None
+		for result in results:
+			assert pool.fetch_download(result, True).getvalue() == b'content'
+		assert not pool._downloads
+	finally:
+		pool.shutdown()
+		server.shutdown()
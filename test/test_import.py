@@ -0,0 +1,24 @@
+import json
+import subprocess
+import sys
+import pytest
+
+# Importing pyrus should neither start manager processes nor take long
+IMPORT_TIME_BUDGET = 0.5
+
+_probe = '''
+import json, sys, time
+from multiprocessing import active_children
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(json.dumps([time.perf_counter() - start, len(active_children())]))
+'''
+
+@pytest.mark.parametrize('module', ['pyrus', 'pyrus.archives',
+	'pyrus.checksum', 'pyrus.mplogging', 'pyrus.util', 'pyrus.web',
+	'pyrus.web.download'])
+def test_import_is_cheap(module):
+	output = subprocess.check_output([sys.executable, '-c', _probe, module])
+	elapsed, children = json.loads(output)
+	assert children == 0
+	assert elapsed < IMPORT_TIME_BUDGET
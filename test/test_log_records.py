@@ -0,0 +1,145 @@
+from pyrus.mplogging import _Logging, read_log, decode_records, encode_record
+from pyrus.mplogging import encode_name, INFO, WARN
+
+def test_record_round_trip():
+	data = encode_name(3, 'n') + encode_record(1.5, 42, WARN, 3, 'café')
+	record, = decode_records(data)
+	assert (record.name, record.level, record.msg, record.pid) == \
+		('n', WARN, 'café', 42)
+	record, = decode_records(encode_record(1.5, 42, INFO, 7, 'm'),
+							{7: 'table'}.get)
+	assert record.name == 'table'
+	# Any object is logged as its %s
+	record, = decode_records(encode_record(1.5, 42, INFO, 7, ValueError('boom')))
+	assert record.msg == 'boom'
+
+def test_log_objects():
+	# Run on its own, so that the logging manager prints to our pipe
+	import subprocess, sys
+	script = ("from pyrus.mplogging import Logger\n"
+		"logger = Logger('objects')\n"
+		"logger.info(123)\n"
+		"logger.error(ValueError('boom'))\n"
+		"logger.info(None)\n")
+	output = subprocess.check_output([sys.executable, '-c', script],
+									universal_newlines=True)
+	assert [ line.split('] ')[-1] for line in output.splitlines()
+		if '[objects]' in line ] == ['123', 'boom', 'None']
+
+def test_log_sink(tmp_path):
+	path = str(tmp_path / 'sink.log')
+	for run in range(2):
+		logging = type('SinkLogging%d' % run, (_Logging,), {})(sink=path)
+		logging.log('first', INFO, 'one %d' % run, 1)
+		logging.log('x' * 200, WARN, 'long name', 2)
+		logging.log('first', INFO, 'two', 3)
+		logging.shutdown(None)
+	records = [ (r.name, r.msg, r.pid) for r in read_log(path) ]
+	assert records == [ record for run in range(2) for record in [
+		('first', 'one %d' % run, 1), ('x' * 200, 'long name', 2),
+		('first', 'two', 3)] ]
+
+def test_throttle():
+	from pyrus.mplogging import _Throttle, REPEAT_MESSAGE
+	def call(throttle, msg):
+		return throttle.admit(INFO, msg, 1)
+	throttle = _Throttle()
+	throttle.set_collapse_repeats()
+	sent = [ call(throttle, m) for m in ['a', 'a', 'a', 'b', 'b', 'a'] ]
+	assert sent == [[(INFO, 'a')], [], [], [(INFO, REPEAT_MESSAGE % 2),
+		(INFO, 'b')], [], [(INFO, REPEAT_MESSAGE % 1), (INFO, 'a')]]
+	throttle = _Throttle()
+	throttle.set_rate_limit(0.001, burst=3)
+	assert sum(len(call(throttle, str(i))) for i in range(100)) == 3
+	# Each call site has a bucket of its own
+	assert call(throttle, 'other site')
+	throttle = _Throttle()
+	throttle.set_sampling(0)
+	assert not any(call(throttle, str(i)) for i in range(100))
+	assert throttle.suppressed == 100
+	# Each call site keeps its share of calls
+	throttle = _Throttle()
+	throttle.set_sampling(0.25)
+	first = sum(len(call(throttle, str(i))) for i in range(100))
+	second = sum(len(call(throttle, str(i))) for i in range(20))
+	assert first == 25 and second == 5
+	throttle = _Throttle()
+	throttle.set_collapse_repeats()
+	call(throttle, 'a'), call(throttle, 'a')
+	assert throttle.flush() == [(INFO, REPEAT_MESSAGE % 1)]
+	assert throttle.flush() == []
+
+def test_pickle_logger():
+	import pickle
+	from pyrus.mplogging import Logger
+	logger = Logger('pickled')
+	logger.set_rate_limit(5, burst=2)
+	logger.set_collapse_repeats()
+	logger._throttle.admit(INFO, 'a', 0)
+	copy = pickle.loads(pickle.dumps(logger))
+	assert (copy._name, copy._throttle.rate, copy._throttle.burst,
+			copy._throttle.collapse) == ('pickled', 5, 2, True)
+	assert copy._throttle._last == {}
+	logger.set_log_level(INFO)
+	copy = pickle.loads(pickle.dumps(logger._logger))
+	assert copy._throttle.rate == 5
+	assert copy.get_log_level() == INFO
+
+_repeat_script = '''
+import sys
+from pyrus.mplogging import Logger, start
+
+logger = Logger('repeat')
+logger.set_collapse_repeats()
+if __name__ == '__main__':
+	start(sink=sys.argv[1])
+	for i in range(3):
+		logger.info('same')
+'''
+
+def test_repeats_flushed_at_exit(tmp_path):
+	import subprocess, sys
+	from pyrus.mplogging import REPEAT_MESSAGE
+	script = tmp_path / 'repeat_script.py'
+	script.write_text(_repeat_script)
+	sink = str(tmp_path / 'repeat.log')
+	subprocess.check_call([sys.executable, str(script), sink])
+	assert [ r.msg for r in read_log(sink) ] == ['same', REPEAT_MESSAGE % 2]
+
+_pool_script = '''
+import sys
+from multiprocessing import get_context
+from pyrus.mplogging import Logger, start
+
+logger = Logger('pool')
+
+def work(i):
+	logger.info('work %d' % i)
+	return i
+
+if __name__ == '__main__':
+	method, sink = sys.argv[1], sys.argv[2]
+	if sink:
+		start(sink=sink)
+	with get_context(method).Pool(2) as pool:
+		assert pool.map(work, range(4)) == list(range(4))
+'''
+
+def test_pool_workers(tmp_path):
+	# A module level logger first used in pool workers, which are daemonic
+	# and cannot start a logging manager of their own
+	import subprocess, sys
+	script = tmp_path / 'pool_script.py'
+	script.write_text(_pool_script)
+	expected = [ 'work %d' % i for i in range(4) ]
+	for method in ('fork', 'spawn'):
+		output = subprocess.check_output([sys.executable, str(script), method,
+									''], universal_newlines=True)
+		assert sorted(line.split('] ')[-1] for line in output.splitlines()) \
+			== expected
+		# Workers log through the manager started by the parent
+		sink = str(tmp_path / (method + '.log'))
+		output = subprocess.check_output([sys.executable, str(script), method,
+									sink], universal_newlines=True)
+		assert output == ''
+		assert sorted(r.msg for r in read_log(sink)) == expected
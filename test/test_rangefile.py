@@ -0,0 +1,92 @@
+import os
+import re
+import threading
+import zipfile
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from pyrus.archives import make_archive_obj, ZipFile
+from pyrus.web import HTTPRangeFile, RangeNotSupportedException
+
+MEMBERS = dict(('member%02d' % i, os.urandom(64 << 10)) for i in range(50))
+
+def _make_zip():
+	bio = BytesIO()
+	with zipfile.ZipFile(bio, 'w', zipfile.ZIP_DEFLATED) as zf:
+		for name, data in sorted(MEMBERS.items()):
+			zf.writestr(name, data)
+	return bio.getvalue()
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	data = _make_zip()
+	etag = '"v1"'
+	# Breaks the responses: moves their start, or cuts their body short
+	skew = 0
+	cut = 0
+
+	def log_message(self, *args):
+		pass
+
+	def do_HEAD(self):
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(self.data)))
+		self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('ETag', self.etag)
+		self.end_headers()
+
+	def do_GET(self):
+		match = re.match(r'bytes=(\d+)-(\d+)$', self.headers['Range'] or '')
+		if not match or self.headers['If-Range'] not in (None, self.etag):
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(self.data)))
+			self.end_headers()
+			self.wfile.write(self.data)
+			return
+		start = int(match.group(1)) + self.skew
+		body = self.data[start:int(match.group(2)) + 1]
+		self.send_response(206)
+		self.send_header('Content-Range', 'bytes %d-%d/%d'
+						% (start, start + len(body) - 1, len(self.data)))
+		body = body[:len(body) - self.cut]
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('ETag', self.etag)
+		self.end_headers()
+		self.wfile.write(body)
+
+def test_remote_zip(monkeypatch):
+	server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	url = 'http://127.0.0.1:%d/remote.zip' % server.server_port
+	try:
+		remote = HTTPRangeFile(url, block_size=4096)
+		archive = make_archive_obj(url, remote)
+		assert isinstance(archive, ZipFile)
+		assert archive.filelist == sorted(MEMBERS)
+		assert archive.extract('member07').read() == MEMBERS['member07']
+		# The central directory and one member, not the whole archive
+		assert remote.bytes_fetched < len(_Handler.data) // 10
+		remote.seek(0)
+		assert remote.read() == _Handler.data
+		assert make_archive_obj(url).extract('member42').read() == \
+			MEMBERS['member42']
+		# Reads ahead never evict the blocks of the read from a small cache
+		for cache_blocks in (1, 2, 4):
+			small = HTTPRangeFile(url, block_size=4096, cache_blocks=cache_blocks)
+			chunks = [ small.read(3000) for _ in range(20) ]
+			assert b''.join(chunks) == _Handler.data[:60000]
+			assert len(small._blocks) <= cache_blocks
+			small.seek(100)
+			assert small.read(5 * 4096) == _Handler.data[100:100 + 5 * 4096]
+		for attr in ('skew', 'cut'):
+			broken = HTTPRangeFile(url, block_size=4096)
+			with monkeypatch.context() as patch:
+				patch.setattr(_Handler, attr, 1)
+				with pytest.raises(IOError):
+					broken.read(10)
+		changed = HTTPRangeFile(url, block_size=4096)
+		monkeypatch.setattr(_Handler, 'etag', '"v2"')
+		with pytest.raises(RangeNotSupportedException):
+			changed.read(10)
+	finally:
+		server.shutdown()
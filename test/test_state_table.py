@@ -0,0 +1,27 @@
+from multiprocessing import Process
+import pytest
+from pyrus import SharedStateTable, StateTableFullException
+
+def _writer(table, keys):
+	for i, key in enumerate(keys):
+		table[key] = i
+
+def test_shared_state_table():
+	table = SharedStateTable(64)
+	keys = [ 'http://example.com/%d' % i for i in range(40) ]
+	p = Process(target=_writer, args=(table, keys))
+	p.start()
+	p.join()
+	assert [ table.get(key) for key in keys ] == list(range(40))
+	assert 'http://example.com/missing' not in table
+	for key in keys[::2]:
+		table.discard(key)
+	assert [ key in table for key in keys[:4] ] == [False, True, False, True]
+	table[keys[1]] = 7
+	assert table[keys[1]] == 7
+	for i in range(44):
+		table['more/%d' % i] = i
+	with pytest.raises(StateTableFullException):
+		table['overflow'] = 1
+	with pytest.raises(KeyError):
+		table[keys[0]]